@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Benchmarks for the distributed locks and the replicated database.
+
+A local name service and groups of peers of growing size are started on
+this machine. A scripted workload is run against every group and the
+following is reported:
+    --  the throughput,
+    --  the latency percentiles of the operations,
+    --  the number of messages (remote calls) between peers per
+        operation.
+
+The 'lock' workload runs all the peers in this process, each of them
+repeatedly acquiring and releasing its distributed lock. The 'replica'
+workload starts every lab5 server in its own process, with clients
+reading fortunes and then writing some. The messages of the replica
+workload are the calls the servers report through call_counts().
+
+"""
+
+import os
+import sys
+import time
+import shlex
+import shutil
+import socket
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+import collections
+
+sys.path.append("../modules")
+from Common import orb
+from Common import nameService
+
+from Server.peerList import PeerList
+from Server.Lock.distributedLock import DistributedLock
+from Server.Lock.quorumLock import QuorumLock
+from Server.Lock.lockManager import LockManager
+
+# -----------------------------------------------------------------------------
+# Initialize and read the command line arguments
+# -----------------------------------------------------------------------------
+
+rand = random.Random()
+rand.seed()
+description = """\
+Benchmark the distributed locks or the replicated database with a growing
+number of local peers.\
+"""
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument(
+    "-w", "--workload", dest="workload", default="lock",
+    choices=["lock", "replica"],
+    help="Acquire and release a distributed lock, or read and write a "
+         "replicated database. Default: lock."
+)
+parser.add_argument(
+    "-n", "--peers", metavar="N", dest="peers", type=int, nargs="+",
+    default=[2, 4, 8], help="The numbers of peers to run. Default: 2 4 8."
+)
+parser.add_argument(
+    "-o", "--ops", metavar="OPS", dest="ops", type=int, default=50,
+    help="Operations per peer (lock) or per client (replica). Default: 50."
+)
+parser.add_argument(
+    "-l", "--lock", dest="lock", default="token",
+    choices=["token", "quorum", "manager"],
+    help="The lock engine of the lock workload. 'manager' uses named "
+         "locks, a random one of KEYS for every operation. Default: token."
+)
+parser.add_argument(
+    "-k", "--keys", metavar="KEYS", dest="keys", type=int, default=8,
+    help="The number of named locks used by 'manager'. Default: 8."
+)
+parser.add_argument(
+    "--hold", metavar="SECONDS", dest="hold", type=float, default=0.0,
+    help="Time the lock is held in every critical section. Default: 0."
+)
+parser.add_argument(
+    "-c", "--clients", metavar="CLIENTS", dest="clients", type=int,
+    default=4, help="Clients of the replica workload. Default: 4."
+)
+parser.add_argument(
+    "-r", "--write-ratio", metavar="RATIO", dest="write_ratio", type=float,
+    default=0.1, help="Part of the operations that are writes. Default: 0.1."
+)
+parser.add_argument(
+    "-f", "--file", metavar="FILE", dest="file",
+    default="../lab5/dbs/fortune.db",
+    help="The database every replica starts with. "
+         "Default: ../lab5/dbs/fortune.db."
+)
+parser.add_argument(
+    "-s", "--server-args", metavar="ARGS", dest="server_args", default="",
+    help="Extra options of the lab5 servers, e.g., '--shards 4'."
+)
+opts = parser.parse_args()
+
+lab5_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                        "lab5")
+
+
+# -----------------------------------------------------------------------------
+# Auxiliary classes and functions
+# -----------------------------------------------------------------------------
+
+
+class LockPeer(orb.Peer):
+
+    """Peer with a distributed lock, as in lab4."""
+
+    def __init__(self, local_address, ns_address, ptype, engine):
+        orb.Peer.__init__(self, local_address, ns_address, ptype)
+        self.peer_list = PeerList(self)
+        if engine == "quorum":
+            self.distributed_lock = QuorumLock(self, self.peer_list)
+        elif engine == "manager":
+            self.distributed_lock = LockManager(self, self.peer_list)
+        else:
+            self.distributed_lock = DistributedLock(self, self.peer_list)
+        self.dispatched_calls = self.distributed_lock.remote_calls()
+        orb.Peer.start(self)
+        self.peer_list.initialize()
+        self.distributed_lock.initialize()
+
+    def __getattr__(self, attr):
+        """Forward calls are dispatched here."""
+
+        if attr in self.dispatched_calls:
+            return self.dispatched_calls[attr]
+        else:
+            raise AttributeError(
+                "LockPeer instance has no attribute '{0}'".format(attr))
+
+    def destroy(self):
+        orb.Peer.destroy(self)
+        self.distributed_lock.destroy()
+        self.peer_list.destroy()
+
+    def register_peer(self, pid, paddr):
+        self.peer_list.register_peer(pid, paddr)
+        self.distributed_lock.register_peer(pid)
+
+    def unregister_peer(self, pid):
+        self.peer_list.unregister_peer(pid)
+        self.distributed_lock.unregister_peer(pid)
+
+
+def free_port():
+    """Return a free local port in the range of the labs."""
+
+    while True:
+        port = rand.randint(40001, 49999)
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.bind(("", port))
+            return port
+        except OSError:
+            continue
+        finally:
+            s.close()
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values (nearest rank)."""
+
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = max(0, int(round(p / 100.0 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def report(peers, op, latencies, elapsed, messages):
+    """Print one line of results. Latencies are in seconds."""
+
+    ms = [1000 * t for t in latencies]
+    rate = len(ms) / elapsed if elapsed > 0 else 0.0
+    per_op = "-" if messages is None else "{:.1f}".format(
+        messages / max(len(ms), 1))
+    print("{:>5} {:>6} {:>7} {:>9.1f} {:>8} {:>8.1f} {:>8.1f} {:>8.1f} "
+          "{:>8.1f}".format(peers, op, len(ms), rate, per_op,
+                            percentile(ms, 50), percentile(ms, 90),
+                            percentile(ms, 99), max(ms or [0])))
+
+
+def run_locks(n, ns_address):
+    """Run the lock workload with n peers in this process."""
+
+    ptype = "bench-lock-{}-{}".format(os.getpid(), n)
+    keys = ["key-{}".format(i) for i in range(opts.keys)]
+    latencies = []
+    inside = collections.Counter()
+    violations = [0]
+    stats_lock = threading.Lock()
+
+    def work(peer):
+        lock = peer.distributed_lock
+        for _ in range(opts.ops):
+            key = rand.choice(keys) if opts.lock == "manager" else None
+            start = time.perf_counter()
+            if key is None:
+                lock.acquire()
+            else:
+                lock.acquire(key)
+            waited = time.perf_counter() - start
+            with stats_lock:
+                latencies.append(waited)
+                inside[key] += 1
+                if inside[key] > 1:
+                    violations[0] += 1
+            if opts.hold > 0:
+                time.sleep(opts.hold)
+            with stats_lock:
+                inside[key] -= 1
+            if key is None:
+                lock.release()
+            else:
+                lock.release(key)
+
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            peers = [LockPeer(("127.0.0.1", free_port()), ns_address, ptype,
+                              opts.lock) for _ in range(n)]
+            messages = sum(orb.call_counts().values())
+            start = time.perf_counter()
+            workers = [threading.Thread(target=work, args=(peer,))
+                       for peer in peers]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            messages = sum(orb.call_counts().values()) - messages
+            for peer in peers:
+                peer.destroy()
+
+    report(n, "lock", latencies, elapsed, messages)
+    if violations[0]:
+        print("Mutual exclusion was violated {} times!".format(violations[0]))
+
+
+def count_calls(addresses):
+    """Count the remote calls the servers have made so far."""
+
+    return sum(sum(orb.Stub(address).call_counts().values())
+               for address in addresses)
+
+
+def run_replicas(n, name_service, ns_address):
+    """Run the replica workload with n lab5 servers in subprocesses.
+
+    Returns the lines of the report.
+
+    """
+
+    ptype = "bench-replica-{}-{}".format(os.getpid(), n)
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    env = dict(os.environ, PYTHONUNBUFFERED="1",
+               NAME_SERVICE="{}:{}".format(*ns_address))
+    servers = []
+    logs = []
+    try:
+        for i in range(n):
+            db_file = os.path.join(tmp, "fortune_{}.db".format(i))
+            shutil.copy(opts.file, db_file)
+            logs.append(os.path.join(tmp, "server_{}.log".format(i)))
+            with open(logs[-1], "w") as log:
+                servers.append(subprocess.Popen(
+                    [sys.executable, "serverPeer.py", "-p", str(free_port()),
+                     "-t", ptype, "-f", db_file] +
+                    shlex.split(opts.server_args),
+                    cwd=lab5_dir, env=env, stdin=subprocess.PIPE,
+                    stdout=log, stderr=subprocess.STDOUT,
+                    universal_newlines=True))
+            # Start the servers one at a time, as test.sh does.
+            deadline = time.monotonic() + 30
+            while True:
+                with open(logs[-1], "r") as data:
+                    if "Choose one of the following commands" in data.read():
+                        break
+                if (time.monotonic() > deadline or
+                        servers[-1].poll() is not None):
+                    raise Exception("Server {} did not start, see {}".format(
+                        i, logs[-1]))
+                time.sleep(0.05)
+
+        addresses = [tuple(addr)
+                     for _, addr in name_service.require_all(ptype)]
+        stats_lock = threading.Lock()
+
+        def work(client, kind, latencies, ops):
+            for j in range(ops):
+                server = orb.Stub(rand.choice(addresses))
+                start = time.perf_counter()
+                if kind == "write":
+                    server.write("Benchmark fortune {} {}.".format(client, j))
+                else:
+                    server.read()
+                with stats_lock:
+                    latencies.append(time.perf_counter() - start)
+
+        # The reads and the writes are run one after the other, so that
+        # the calls between the servers can be told apart.
+        writes = int(round(opts.ops * opts.write_ratio))
+        results = []
+        for kind, ops in (("read", opts.ops - writes), ("write", writes)):
+            latencies = []
+            calls = count_calls(addresses)
+            start = time.perf_counter()
+            clients = [threading.Thread(target=work,
+                                        args=(c, kind, latencies, ops))
+                       for c in range(opts.clients)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.perf_counter() - start
+            messages = count_calls(addresses) - calls
+            results.append((n, kind, latencies, elapsed, messages))
+    finally:
+        for server in servers:
+            try:
+                server.stdin.write("q\n")
+                server.stdin.flush()
+            except OSError:
+                pass
+        for server in servers:
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return results
+
+
+# -----------------------------------------------------------------------------
+# The main program
+# -----------------------------------------------------------------------------
+
+ns_address = ("127.0.0.1", free_port())
+name_service = nameService.start(ns_address)
+
+print("{:>5} {:>6} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+    "peers", "op", "count", "ops/s", "msgs/op", "p50 ms", "p90 ms",
+    "p99 ms", "max ms"))
+for n in opts.peers:
+    if opts.workload == "lock":
+        run_locks(n, ns_address)
+    else:
+        # The name service runs here and logs every request.
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                results = run_replicas(n, name_service, ns_address)
+        for result in results:
+            report(*result)
@@ -39,8 +39,10 @@ opts = parser.parse_args()
 # The main program
 # -----------------------------------------------------------------------------
 
-# Create the database object
-db = Database("dbs/fortune.db")
+# Create the database object. When we only read, map the file read-only
+# instead of loading it.
+read_only = opts.fortune is None and not opts.interactive
+db = Database("dbs/fortune.db", read_only=read_only)
 
 if not opts.interactive:
     # Run in the normal mode
@@ -16,6 +16,9 @@ import socket
 import json
 import argparse
 
+sys.path.append("../modules")
+from Server.database import read_fortunes
+
 # -----------------------------------------------------------------------------
 # Initialize and read the command line arguments
 # -----------------------------------------------------------------------------
@@ -41,6 +44,22 @@ parser.add_argument(
     "-i", "--interactive", action="store_true", dest="interactive",
     default=False, help="Interactive session with the fortune database."
 )
+parser.add_argument(
+    "-f", "--import", metavar="FILE", dest="import_file",
+    help="Write all the fortunes of a fortune file to the database."
+)
+parser.add_argument(
+    "-q", "--search", metavar="QUERY", dest="query",
+    help="Print the fortunes containing all the words of QUERY."
+)
+parser.add_argument(
+    "-n", "--count", metavar="N", dest="count", type=int, default=None,
+    help="Read N random fortunes from the database in one request."
+)
+parser.add_argument(
+    "-u", "--unique", action="store_true", dest="unique", default=False,
+    help="With -n, do not return the same fortune twice."
+)
 parser.add_argument(
     "address", type=address, nargs=1, metavar="addr:port",
     help="Server address."
@@ -64,41 +83,44 @@ class DatabaseProxy(object):
     def __init__(self, server_address):
         self.address = server_address
 
-    # Public methods
+    # Private methods
 
-    def read(self):
-        #
-        # Your code here.
-        #
-        arguments = []
-        message = {"method": "read" , "args": arguments}
+    def _call(self, method, *args):
+        """Call method(*args) on the database server, in one round-trip."""
+        message = {"method": method, "args": list(args)}
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(self.address)
-        data = s.makefile(mode="rw")
-        data.write(json.dumps(message) + '\n')
-        data.flush()
-        result = json.loads(data.readline())
-        data.flush()
-        s.close()
+        try:
+            s.connect(self.address)
+            data = s.makefile(mode="rw")
+            data.write(json.dumps(message) + '\n')
+            data.flush()
+            result = json.loads(data.readline())
+        finally:
+            s.close()
+        if isinstance(result, dict) and "error" in result:
+            raise ComunicationError(result["error"]["name"],
+                                    result["error"]["args"])
         return result
-        pass
+
+    # Public methods
+
+    def read(self):
+        return self._call("read")
 
     def write(self, fortune):
-        #
-        # Your code here.
-        #
-        message = {"method": "write" , "args": fortune}
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(self.address)
-        data = s.makefile(mode="rw")
-        data.write(json.dumps(message) + '\n')
-        data.flush()
-        result = json.loads(data.readline())
-        data.flush()
-        s.close()
-        if result:
-            print(result)
-        pass
+        return self._call("write", fortune)
+
+    def read_many(self, n, unique=False):
+        """Read n random fortunes in a single round-trip."""
+        return self._call("read_many", n, unique)
+
+    def search(self, query, limit=10):
+        """Return at most limit fortunes containing all words of query."""
+        return self._call("search", query, limit)
+
+    def write_many(self, fortunes):
+        """Write a batch of fortunes in a single round-trip."""
+        return self._call("write_many", list(fortunes))
 
 # -----------------------------------------------------------------------------
 # The main program
@@ -111,6 +133,15 @@ if not opts.interactive:
     # Run in the normal mode.
     if opts.fortune is not None:
         db.write(opts.fortune)
+    elif opts.import_file is not None:
+        count = db.write_many(read_fortunes(opts.import_file))
+        print("Imported {} fortunes.".format(count))
+    elif opts.query is not None:
+        for fortune in db.search(opts.query):
+            print(fortune)
+    elif opts.count is not None:
+        for fortune in db.read_many(opts.count, opts.unique):
+            print(fortune)
     else:
         print(db.read())
 
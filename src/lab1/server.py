@@ -19,8 +19,8 @@ import argparse
 
 import sys
 sys.path.append("../modules")
-from Server.database import Database
-from Server.Lock.readWriteLock import ReadWriteLock
+from Server.database import Database, ROUND_ROBIN, HASH
+from Server.Lock import readWriteLock
 
 # -----------------------------------------------------------------------------
 # Initialize and read the command line arguments
@@ -43,6 +43,30 @@ parser.add_argument(
     "-f", "--file", metavar="FILE", dest="file", default="dbs/fortune.db",
     help="Set the database file. Default: dbs/fortune.db."
 )
+parser.add_argument(
+    "-s", "--shards", metavar="N", dest="shards", type=int, default=1,
+    help="Split the database over N shard files, each with its own lock. "
+         "Default: 1."
+)
+parser.add_argument(
+    "-r", "--route", dest="route", default=ROUND_ROBIN,
+    choices=[ROUND_ROBIN, HASH],
+    help="How new fortunes are assigned to shards. Default: round-robin."
+)
+parser.add_argument(
+    "-x", "--index", action="store_true", dest="index", default=False,
+    help="Keep a search index over the fortunes, saved next to the data."
+)
+parser.add_argument(
+    "--read-only", action="store_true", dest="read_only", default=False,
+    help="Serve the database read-only from a memory mapped file."
+)
+parser.add_argument(
+    "-l", "--lock-policy", dest="policy", default="writer",
+    choices=["reader", "writer", "fifo"],
+    help="Let readers or writers go first when both wait for a shard, or "
+         "serve them in arrival order. Default: writer."
+)
 opts = parser.parse_args()
 
 db_file = opts.file
@@ -55,33 +79,36 @@ server_address = ("", opts.port)
 
 class Server(object):
 
-    """Class that provides synchronous access to the database."""
+    """Class that provides synchronous access to the database.
 
-    def __init__(self, db_file):
-        self.db = Database(db_file)
-        self.rwlock = ReadWriteLock()
+    The database guards each of its shards with its own readers-writers
+    lock, so writes to different shards proceed in parallel.
+
+    """
+
+    def __init__(self, db_file, shards=1, route=ROUND_ROBIN, index=False,
+                 read_only=False, policy=readWriteLock.WRITER_PREFERRING):
+        self.db = Database(db_file, shards, route, index, read_only, policy)
 
     # Public methods
 
     def read(self):
-        #
-        # Your code here.
-        #
-        self.rwlock.read_acquire()
-        result = self.db.read()
-        self.rwlock.read_release()
-        return result
-        pass
+        return self.db.read()
+
+    def read_many(self, n, unique=False):
+        """Read n random fortunes in one call."""
+        return self.db.read_many(n, unique)
+
+    def search(self, query, limit=10):
+        """Return at most limit fortunes containing all words of query."""
+        return self.db.search(query, limit)
 
     def write(self, fortune):
-        #
-        # Your code here.
-        #
-        self.rwlock.write_acquire()
-        result = self.db.write(fortune)
-        self.rwlock.write_release()
-        return result
-        pass
+        return self.db.write(fortune)
+
+    def write_many(self, fortunes):
+        """Write a batch of fortunes in one call."""
+        return self.db.write_many(fortunes)
 
 
 class Request(threading.Thread):
@@ -90,6 +117,9 @@ class Request(threading.Thread):
         Each request is handled in a separate thread.
     """
 
+    # The methods of the database server clients may call.
+    methods = ("read", "write", "read_many", "search", "write_many")
+
     def __init__(self, db_server, conn, addr):
         threading.Thread.__init__(self)
         self.db_server = db_server
@@ -122,30 +152,24 @@ class Request(threading.Thread):
                         }
                     }
         """
-        #
-        # Your code here.
-        # {arg: data,arg2: data2}
         print("Processing request")
-        incoming = json.loads(request)
-        print(incoming['method'])
-        if incoming != None and incoming['method'] != None and incoming['args'] != None:
-            if incoming['method'] == "write" and len(incoming['args']) > 0:
-                print(incoming['args'])
-                result = json.dumps(self.db_server.write(incoming['args']))
-            elif incoming['method'] == "read":
-                print("in read server")
-                #result = json.dumps({"result": self.db_server.read()})
-                result = json.dumps(self.db_server.read())
-            else:
-                # throw some error
-                print("in error")
-                result = json.dumps({"error" : {"name": "Unknown method" , "args": incoming['method']}})
-        else:
-            # throw some error
-            print("in error")
-            result = json.dumps({"error" : {"name": "Unknown method" , "args": incoming['method']}})
-        return result
-        pass
+        try:
+            incoming = json.loads(request)
+            method = incoming["method"]
+            args = incoming["args"]
+        except (ValueError, KeyError, TypeError):
+            return self.error("Bad request", [request])
+        if method not in self.methods:
+            return self.error("Unknown method", method)
+        print(method)
+        try:
+            return json.dumps(getattr(self.db_server, method)(*args))
+        except Exception as e:
+            return self.error(e.__class__.__name__, e.args)
+
+    def error(self, name, args):
+        """Return the JSON answer for an error."""
+        return json.dumps({"error": {"name": name, "args": args}})
 
     def run(self):
         try:
@@ -176,7 +200,13 @@ print("Listening to: {}:{}".format(socket.gethostname(), opts.port))
 with open("srv_address.tmp", "w") as f:
     f.write("{}:{}\n".format(socket.gethostname(), opts.port))
 
-sync_db = Server(db_file)
+policies = {
+    "reader": readWriteLock.READER_PREFERRING,
+    "writer": readWriteLock.WRITER_PREFERRING,
+    "fifo": readWriteLock.FIFO,
+}
+sync_db = Server(db_file, opts.shards, opts.route, opts.index,
+                 opts.read_only, policies[opts.policy])
 
 server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 server.bind(server_address)
@@ -23,6 +23,7 @@ from Common.objectType import object_type
 
 from Server.peerList import PeerList
 from Server.Lock.distributedLock import DistributedLock
+from Server.Lock.quorumLock import QuorumLock
 
 # -----------------------------------------------------------------------------
 # Initialize and read the command line arguments
@@ -42,10 +43,29 @@ parser.add_argument(
     "-t", "--type", metavar="TYPE", dest="type", default=object_type,
     help="Set the type of the client."
 )
+parser.add_argument(
+    "-l", "--lock", dest="lock", default="token", choices=["token", "quorum"],
+    help="The distributed lock engine: a circulating token (Ricart-Agrawala) "
+         "or quorum votes (Maekawa). All peers must use the same engine. "
+         "Default: token."
+)
+parser.add_argument(
+    "--token-timeout", metavar="SECONDS", dest="token_timeout", type=float,
+    default=None,
+    help="Look for a lost token after waiting SECONDS for it. "
+         "By default, the token is assumed never to be lost."
+)
+parser.add_argument(
+    "--max-hold", metavar="SECONDS", dest="max_hold", type=float,
+    default=None, help="Take the lock away after it is held for SECONDS."
+)
 opts = parser.parse_args()
 
 local_port = opts.port
 client_type = opts.type
+lock_engine = opts.lock
+token_timeout = opts.token_timeout
+max_hold = opts.max_hold
 assert client_type != "object", "Change the object type to something unique!"
 
 # -----------------------------------------------------------------------------
@@ -61,15 +81,18 @@ class Client(orb.Peer):
         """Initialize the client."""
         orb.Peer.__init__(self, local_address, ns_address, client_type)
         self.peer_list = PeerList(self)
-        self.distributed_lock = DistributedLock(self, self.peer_list)
+        if lock_engine == "quorum":
+            self.distributed_lock = QuorumLock(self, self.peer_list)
+        else:
+            self.distributed_lock = DistributedLock(
+                self, self.peer_list, token_timeout, max_hold)
         self.dispatched_calls = {
             "display_peers":      self.peer_list.display_peers,
             "acquire":            self.distributed_lock.acquire,
             "release":            self.distributed_lock.release,
-            "request_token":      self.distributed_lock.request_token,
-            "obtain_token":       self.distributed_lock.obtain_token,
             "display_status":     self.distributed_lock.display_status
         }
+        self.dispatched_calls.update(self.distributed_lock.remote_calls())
         orb.Peer.start(self)
         self.peer_list.initialize()
         self.distributed_lock.initialize()
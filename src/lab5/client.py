@@ -18,6 +18,9 @@ sys.path.append("../modules")
 from Common import orb
 from Common.nameServiceLocation import name_service_address
 from Common.objectType import object_type
+from Common.replicaRouter import ReplicaRouter
+from Server.database import read_fortunes
+from Server.Replication.replicationLog import StaleReplica, merge_versions
 
 # -----------------------------------------------------------------------------
 # Initialize and read the command line arguments
@@ -44,10 +47,45 @@ parser.add_argument(
     "-p", "--peer", metavar="PEER_ID", dest="peer_id", type=int,
     help="The identifier of a particular server peer."
 )
+parser.add_argument(
+    "--hedge", metavar="SECONDS", dest="hedge", type=float, default=None,
+    help="Without -p, send reads taking more than SECONDS to a second "
+         "server as well. By default, reads are not hedged."
+)
+parser.add_argument(
+    "--read-quorum", metavar="R", dest="read_quorum", type=int,
+    default=None,
+    help="With servers in the quorum mode, read the latest version of R "
+         "servers. Default: the read quorum of the servers."
+)
+parser.add_argument(
+    "--write-quorum", metavar="W", dest="write_quorum", type=int,
+    default=None,
+    help="With servers in the quorum mode, return once W servers have "
+         "applied a write. Default: the write quorum of the servers."
+)
+parser.add_argument(
+    "-f", "--import", metavar="FILE", dest="import_file",
+    help="Write all the fortunes of a fortune file to the database."
+)
+parser.add_argument(
+    "-q", "--search", metavar="QUERY", dest="query",
+    help="Print the fortunes containing all the words of QUERY."
+)
+parser.add_argument(
+    "-n", "--count", metavar="N", dest="count", type=int, default=None,
+    help="Read N random fortunes from the database in one request."
+)
+parser.add_argument(
+    "-u", "--unique", action="store_true", dest="unique", default=False,
+    help="With -n, do not return the same fortune twice."
+)
 opts = parser.parse_args()
 
 server_type = opts.type
 server_id = opts.peer_id
+r = opts.read_quorum
+w = opts.write_quorum
 assert server_type != "object", "Change the object type to something unique!"
 
 # -----------------------------------------------------------------------------
@@ -58,22 +96,48 @@ assert server_type != "object", "Change the object type to something unique!"
 ns = orb.Stub(name_service_address)
 
 if server_id is None:
-    server_address = tuple(ns.require_any(server_type))
+    # Send every request to the fastest server that responds.
+    db = ReplicaRouter(ns, server_type, hedge_after=opts.hedge)
+    print("Connecting to the servers: {}".format(
+        ", ".join(str(tuple(r[1])) for r in db.replicas())))
 else:
     server_address = tuple(ns.require_object(server_type, server_id))
+    print("Connecting to server: {}".format(server_address))
+    db = orb.Stub(server_address)
+
+# The version of the writes of this session.
+version = []
+
+
+def read():
+    """Read a fortune that reflects the writes of this session."""
 
-print("Connecting to server: {}".format(server_address))
+    try:
+        return db.read(version, r)
+    except Exception as e:
+        if type(e).__name__ != StaleReplica.__name__:
+            raise
+        # The server is behind: read from one that has our writes.
+        return orb.Stub(ns.require_object(server_type, e.args[1])).read(
+            version, r)
 
-# Create the database object.
-db = orb.Stub(server_address)
 
 if not opts.interactive:
     # Run in the normal mode.
     if opts.fortune is not None:
         print("Writing '{}' to the fortune database.".format(opts.fortune))
-        db.write(opts.fortune)
+        db.write(opts.fortune, w)
+    elif opts.import_file is not None:
+        count = db.write_many(list(read_fortunes(opts.import_file)), w)
+        print("Imported {} fortunes.".format(count))
+    elif opts.query is not None:
+        for fortune in db.search(opts.query, 10, None, r):
+            print(fortune)
+    elif opts.count is not None:
+        for fortune in db.read_many(opts.count, opts.unique, None, r):
+            print(fortune)
     else:
-        print(db.read())
+        print(db.read(None, r))
 
 else:
     # Run in the interactive mode.
@@ -92,9 +156,10 @@ Choose one of the following commands:
         sys.stdout.write("Command> ")
         command = input()
         if command == "r":
-            print(db.read())
+            print(read())
         elif (len(command) > 1 and command[0] == "w" and
                 command[1] in [" ", "\t"]):
-            db.write(command[2:].strip())
+            version = merge_versions(version,
+                                     db.write(command[2:].strip(), w))
         elif command == "h":
             menu()
@@ -19,8 +19,14 @@ data, so they implement 'read any write all' protocol.
 
 import sys
 import random
+import os
+import time
+import base64
 import socket
 import argparse
+import threading
+import collections
+import concurrent.futures
 
 sys.path.append("../modules")
 from Common import orb
@@ -28,9 +34,18 @@ from Common.nameServiceLocation import name_service_address
 from Common.objectType import object_type
 
 from Server import database
-from Server.peerList import PeerList
+from Server.peerList import PeerList, COMMUNICATION_ERRORS
 from Server.Lock.distributedLock import DistributedLock
+from Server.Lock.quorumLock import QuorumLock
+from Server.Lock.lockManager import LockManager
 from Server.Lock.distributedReadWriteLock import DistributedReadWriteLock
+from Server.Lock.readLease import ReadLease
+from Server.Replication import replicator
+from Server.Replication.replicationLog import ReplicationLog, StaleReplica
+from Server.Replication.lockMode import LockMode
+from Server.Replication.primaryMode import PrimaryMode
+from Server.Replication.chainMode import ChainMode
+from Server.Replication.quorumMode import QuorumMode
 
 # -----------------------------------------------------------------------------
 # Initialize and read the command line arguments
@@ -54,7 +69,151 @@ parser.add_argument(
     "-f", "--file", metavar="FILE", dest="file", default="dbs/fortune.db",
     help="Set the database file. Default: dbs/fortune.db."
 )
+parser.add_argument(
+    "-x", "--index", action="store_true", dest="index", default=False,
+    help="Keep a search index over the fortunes, saved next to the data."
+)
+parser.add_argument(
+    "-s", "--shards", metavar="N", dest="shards", type=int, default=1,
+    help="Split the database into N shards, each with its own distributed "
+         "lock, so writes to different shards run in parallel. All peers "
+         "must use the same number of shards. Default: 1."
+)
+parser.add_argument(
+    "--lease-writes", metavar="N", dest="lease_writes", type=int, default=1,
+    help="Keep the write token for up to N queued local writes. Default: 1."
+)
+parser.add_argument(
+    "--lease-time", metavar="SECONDS", dest="lease_time", type=float,
+    default=1.0, help="Keep the write token for at most SECONDS. Default: 1."
+)
+parser.add_argument(
+    "--read-lease", metavar="SECONDS", dest="read_lease", type=float,
+    default=None,
+    help="Serve consistent reads locally under read leases of SECONDS, "
+         "which writers revoke before committing. All peers must use the "
+         "same value. By default, reads may miss writes in progress."
+)
+parser.add_argument(
+    "-a", "--ack", dest="ack", default=replicator.ALL,
+    choices=[replicator.ALL, replicator.MAJORITY, replicator.LOCAL],
+    help="Return from a write once all the replicas, a majority of them or "
+         "only this server have applied it; the others catch up in the "
+         "background. Default: all."
+)
+parser.add_argument(
+    "--failed", dest="failed", default=replicator.DROP,
+    choices=[replicator.DROP, replicator.REPAIR],
+    help="Remove the replicas that do not respond, or queue their missed "
+         "writes until they respond again. Default: drop."
+)
+parser.add_argument(
+    "--batch-size", metavar="N", dest="batch_size", type=int, default=64,
+    help="Send at most N queued writes to a replica in one call. "
+         "Default: 64."
+)
+parser.add_argument(
+    "--batch-delay", metavar="SECONDS", dest="batch_delay", type=float,
+    default=0.0,
+    help="With '--ack local', keep the writes for up to SECONDS before "
+         "sending them, so that more of them are sent together. "
+         "Default: 0."
+)
+parser.add_argument(
+    "--session-wait", metavar="SECONDS", dest="session_wait", type=float,
+    default=0.5,
+    help="Wait up to SECONDS for this server to apply the version a client "
+         "reads at, before sending the client to the server that made the "
+         "write. Default: 0.5."
+)
+parser.add_argument(
+    "--catch-up-limit", metavar="N", dest="catch_up_limit", type=int,
+    default=1000,
+    help="When joining, copy a snapshot of another replica instead of "
+         "replaying more than N missed writes. Default: 1000."
+)
+parser.add_argument(
+    "--snapshot-interval", metavar="SECONDS", dest="snapshot_interval",
+    type=float, default=None,
+    help="Every SECONDS, take a snapshot of the data, which joining replicas "
+         "copy, and drop the writes it contains from the log. By default, "
+         "the log is kept whole and joining replicas copy the current data."
+)
+parser.add_argument(
+    "--anti-entropy", metavar="SECONDS", dest="anti_entropy", type=float,
+    default=None,
+    help="Every SECONDS, compare the data with a random replica and fetch "
+         "the fortunes it has and this server misses. Off by default."
+)
+parser.add_argument(
+    "-m", "--mode", dest="mode", default="lock",
+    choices=["lock", "primary", "chain", "quorum"],
+    help="How the writes are ordered: by the distributed lock, taken by "
+         "every server that writes, or by a primary, the server with the "
+         "lowest id, to which the other servers forward their writes. A new "
+         "primary takes over when it fails. In the 'chain' mode, the writes "
+         "also flow from the primary (the head) through the servers in the "
+         "order of their ids and the last one (the tail) acknowledges them "
+         "and serves all the reads. In the 'quorum' mode, every server "
+         "commits its writes by itself and a write returns once W servers "
+         "have applied it, while a read first fetches the latest version "
+         "from R servers, see --write-quorum and --read-quorum. All peers "
+         "must use the same mode. Default: lock."
+)
+parser.add_argument(
+    "--read-quorum", metavar="R", dest="read_quorum", type=int,
+    default=None,
+    help="In the quorum mode, the number of servers, this one included, a "
+         "read gets the latest version from. With R + W greater than the "
+         "number of servers, every read sees the writes that have "
+         "returned. Clients may ask for another R. Default: a majority."
+)
+parser.add_argument(
+    "--write-quorum", metavar="W", dest="write_quorum", type=int,
+    default=None,
+    help="In the quorum mode, the number of servers, this one included, "
+         "that must apply a write before it returns. Clients may ask for "
+         "another W. Default: a majority."
+)
+parser.add_argument(
+    "-l", "--lock", dest="lock", default="token", choices=["token", "quorum"],
+    help="The distributed lock engine: a circulating token (Ricart-Agrawala) "
+         "or quorum votes (Maekawa). All peers must use the same engine. "
+         "Default: token."
+)
+parser.add_argument(
+    "--token-timeout", metavar="SECONDS", dest="token_timeout", type=float,
+    default=None,
+    help="Look for a lost token after waiting SECONDS for it. "
+         "By default, the token is assumed never to be lost."
+)
+parser.add_argument(
+    "--max-hold", metavar="SECONDS", dest="max_hold", type=float,
+    default=None, help="Take the lock away after it is held for SECONDS."
+)
 opts = parser.parse_args()
+if opts.shards > 1 and opts.lock != "token":
+    parser.error("sharding needs the token lock engine")
+if opts.mode in ("primary", "chain") and opts.failed != replicator.DROP:
+    parser.error("a primary that does not respond must be dropped")
+if opts.mode != "lock" and opts.read_lease is not None:
+    parser.error("read leases need the lock mode")
+if opts.mode == "chain" and opts.ack != replicator.ALL:
+    parser.error("in a chain, the tail acknowledges all the writes")
+if opts.mode == "quorum" and opts.ack != replicator.ALL:
+    parser.error("in the quorum mode, the write quorum replaces --ack")
+if opts.mode != "quorum" and (opts.read_quorum is not None or
+                              opts.write_quorum is not None):
+    parser.error("read and write quorums need the quorum mode")
+if min(opts.read_quorum or 1, opts.write_quorum or 1) < 1:
+    parser.error("a quorum holds at least one server")
+if opts.max_hold is not None and opts.lease_writes > 1:
+    parser.error("the lock would be taken away in the middle of a lease, "
+                 "do not combine --max-hold and --lease-writes")
+if opts.batch_size < 1:
+    parser.error("a batch holds at least one write")
+if opts.read_lease is not None and opts.ack != replicator.ALL:
+    parser.error("read leases need every replica to acknowledge the writes")
 
 local_port = opts.port
 db_file = opts.file
@@ -62,6 +221,10 @@ server_type = opts.type
 assert server_type != "object", "Change the object type to something unique!"
 
 
+# Number of log entries and of snapshot bytes sent per call when joining.
+CATCH_UP_CHUNK = 100
+SNAPSHOT_CHUNK = 1 << 16
+
 # -----------------------------------------------------------------------------
 # Auxiliary classes
 # -----------------------------------------------------------------------------
@@ -71,30 +234,454 @@ class Server(orb.Peer):
 
     """Distributed mutual exclusion client class."""
 
-    def __init__(self, local_address, ns_address, server_type, db_file):
+    def __init__(self, local_address, ns_address, server_type, db_file,
+                 index=False, lease_writes=1, lease_time=1.0,
+                 token_timeout=None, max_hold=None, lock_engine="token",
+                 shards=1, read_lease=None, ack=replicator.ALL,
+                 failed=replicator.DROP, catch_up_limit=1000, batch_size=64,
+                 batch_delay=0.0, session_wait=0.5, mode="lock",
+                 anti_entropy=None, snapshot_interval=None, read_quorum=None,
+                 write_quorum=None):
         """Initialize the client."""
 
         orb.Peer.__init__(self, local_address, ns_address, server_type)
         self.peer_list = PeerList(self)
-        self.distributed_lock = DistributedLock(self, self.peer_list)
-        self.drwlock = DistributedReadWriteLock(self.distributed_lock)
-        self.db = database.Database(db_file)
+        if shards > 1:
+            # One named lock per shard, so that writes to different
+            # shards do not wait for each other.
+            self.distributed_lock = LockManager(
+                self, self.peer_list, token_timeout, max_hold)
+            locks = [self.distributed_lock.get_lock("shard-{}".format(i))
+                     for i in range(shards)]
+        elif lock_engine == "quorum":
+            self.distributed_lock = QuorumLock(self, self.peer_list)
+            locks = [self.distributed_lock]
+        else:
+            self.distributed_lock = DistributedLock(
+                self, self.peer_list, token_timeout, max_hold)
+            locks = [self.distributed_lock]
+        self.drwlocks = [DistributedReadWriteLock(
+            lock, lease_writes=lease_writes, lease_time=lease_time)
+            for lock in locks]
+        if mode == "primary":
+            self.replication = PrimaryMode(self)
+        elif mode == "chain":
+            self.replication = ChainMode(self)
+        elif mode == "quorum":
+            self.replication = QuorumMode(self, read_quorum, write_quorum)
+        else:
+            self.replication = LockMode(self)
+        self.replicator = replicator.Replicator(
+            self, self.peer_list, ack, failed, max_batch=batch_size,
+            batch_delay=batch_delay, on_drop=self.replication.on_drop)
+        self.read_lease = None
+        if read_lease is not None:
+            self.read_lease = ReadLease(read_lease)
+            self.renew_lock = threading.Lock()
+        # The writes queued for every shard, as [fortunes, future] pairs.
+        self.pending = [[] for _ in range(shards)]
+        self.pending_lock = threading.Lock()
+        # Fortunes are routed by hash, so that every replica stores a
+        # fortune in the same shard.
+        self.db_file = db_file
+        self.shards = shards
+        self.index = index
+        self.db = database.Database(db_file, shards, database.HASH, index)
+        self.log = ReplicationLog(db_file + ".log")
+        self.catch_up_limit = catch_up_limit
+        self.session_wait = session_wait
+        self.anti_entropy = anti_entropy
+        # The last snapshot taken: [vector, sizes, extras].
+        self.snapshot = None
+        self.snapshot_interval = snapshot_interval
+        self.stopped = threading.Event()
+        self.synced = threading.Event()
         self.dispatched_calls = {
             "display_peers":      self.peer_list.display_peers,
-            "acquire":            self.distributed_lock.acquire,
-            "release":            self.distributed_lock.release,
-            "request_token":      self.distributed_lock.request_token,
-            "obtain_token":       self.distributed_lock.obtain_token,
-            "display_status":     self.distributed_lock.display_status
         }
+        if shards == 1:
+            # The lock manager needs the key of a lock, so it cannot be
+            # acquired and released as a whole.
+            self.dispatched_calls.update({
+                "acquire":            self.distributed_lock.acquire,
+                "release":            self.distributed_lock.release,
+            })
+        self.dispatched_calls.update(self.distributed_lock.remote_calls())
+        self.dispatched_calls.update(self.replication.remote_calls())
         orb.Peer.start(self)
         self.peer_list.initialize()
         self.distributed_lock.initialize()
+        self._catch_up()
+        self.synced.set()
+        self.replication.start()
+        if anti_entropy is not None:
+            checker = threading.Thread(target=self._anti_entropy_loop)
+            checker.daemon = True
+            checker.start()
+        if snapshot_interval is not None:
+            snapshotter = threading.Thread(target=self._snapshot_loop)
+            snapshotter.daemon = True
+            snapshotter.start()
+
+    # Private methods
+
+    def _split(self, fortunes):
+        """Group fortunes by the shard they are stored in."""
+
+        batches = {}
+        for fortune in fortunes:
+            batches.setdefault(self.db.shard_of(fortune), []).append(fortune)
+        return batches
+
+    def _repair(self, peer):
+        """Fetch the logged writes peer has applied and we have not."""
+
+        while True:
+            answer = peer.log_since(self.log.expected_vector(),
+                                    CATCH_UP_CHUNK)
+            if answer is None:
+                # The writes are only in its snapshot now: wait for
+                # them to reach us.
+                return
+            entries, more = answer
+            for entry in entries:
+                self._apply(self.log.accept(*entry))
+            if not more:
+                return
+
+    def _read_acquire(self, version=None, r=None):
+        """Take the local read locks, under a valid read lease if any.
+
+        Without a valid lease, wait for the writes in progress and renew
+        the lease if it has expired meanwhile. If a version is given,
+        wait for it to be applied first, see read(). The replication
+        mode may bring the version up to date first, with r servers in
+        the quorum mode.
+
+        """
+
+        version = self.replication.read_version(version, r)
+        if version:
+            origin = self.log.wait_for(version, self.session_wait)
+            if origin is not None:
+                raise StaleReplica(
+                    "Server {} has not applied this version yet, read from "
+                    "server {}.".format(self.id, origin), origin)
+        while True:
+            self._read_acquire_local()
+            if self.read_lease is None or self.read_lease.try_acquire():
+                return
+            self._read_release_local()
+            # A joining replica does not renew its lease before it has
+            # caught up.
+            self.synced.wait()
+            if not self.read_lease.wait():
+                self._renew_lease()
+
+    def _read_release(self):
+        if self.read_lease is not None:
+            self.read_lease.release()
+        self._read_release_local()
+
+    def _read_acquire_local(self):
+        for drwlock in self.drwlocks:
+            drwlock.read_acquire()
+
+    def _read_release_local(self):
+        for drwlock in reversed(self.drwlocks):
+            drwlock.read_release()
+
+    def _renew_lease(self):
+        """Renew our read lease while no write is in progress."""
+
+        with self.renew_lock:
+            if self.read_lease.wait():
+                # Somebody renewed it meanwhile.
+                return
+            for drwlock in self.drwlocks:
+                drwlock.write_acquire()
+            try:
+                self.read_lease.renew()
+            finally:
+                for drwlock in reversed(self.drwlocks):
+                    drwlock.write_release()
+
+    def _revoke_leases(self):
+        """Revoke the read leases of all the replicas before a write."""
+
+        if self.read_lease is None:
+            return
+        start = time.monotonic()
+        self.read_lease.revoke(self.id)
+        _, failed = self.peer_list.broadcast("revoke_lease", self.id)
+        if failed:
+            # The replicas we could not reach may still read under
+            # their leases: wait until these have expired.
+            time.sleep(max(0, start + self.read_lease.lease_time -
+                           time.monotonic()))
+
+    def _grant_leases(self):
+        """Grant the read leases back once a write is applied everywhere."""
+
+        if self.read_lease is None:
+            return
+        self.peer_list.broadcast("grant_lease", self.id)
+        self.read_lease.grant(self.id)
+
+    def _commit_pending(self, shard):
+        """Apply and replicate the queued writes of a shard.
+
+        Must be called with the distributed write lock of the shard
+        held. The future of every queued write is resolved with the
+        sequence number of the commit, or failed with its error.
+
+        """
+
+        with self.pending_lock:
+            queued, self.pending[shard] = self.pending[shard], []
+        if not queued:
+            # Our writes were committed by the previous lock holder.
+            return
+        batch = [fortune for fortunes, _ in queued for fortune in fortunes]
+        try:
+            self._revoke_leases()
+            try:
+                if not self.replication.can_commit(shard):
+                    # The lock was taken away meanwhile (max_hold).
+                    raise Exception("The distributed lock was taken away "
+                                    "before the write was committed.")
+                self.db.write_many(batch)
+                # Numbered only once applied, so that a failed write
+                # leaves no gap in our writes.
+                seq = self.log.next_seq(self.id)
+                self.log.record(self.id, seq, batch)
+                self.replication.replicate(seq, batch)
+            finally:
+                self._grant_leases()
+        except Exception as e:
+            for _, future in queued:
+                future.set_exception(e)
+            return
+        for _, future in queued:
+            future.set_result(seq)
+
+    def _commit(self, fortunes):
+        """Queue fortunes and commit them under the write locks.
+
+        Whoever takes the write lock of a shard first commits everything
+        queued for it so far, see _commit_pending(). Returns once our
+        fortunes are committed, with the sequence number of the commit
+        of every shard written to, by shard.
+
+        """
+
+        futures = {}
+        with self.pending_lock:
+            for shard, batch in self._split(fortunes).items():
+                futures[shard] = concurrent.futures.Future()
+                self.pending[shard].append([batch, futures[shard]])
+        for shard in sorted(futures):
+            self.replication.write_acquire(shard)
+            try:
+                self._commit_pending(shard)
+            finally:
+                self.replication.write_release(shard)
+        # The holder that took our writes has resolved their futures
+        # before releasing the lock we have taken since.
+        return dict((shard, future.result())
+                    for shard, future in futures.items())
+
+    def _apply(self, entries):
+        """Apply log entries received from other replicas, in order."""
+
+        for origin, seq, fortunes in entries:
+            shards = sorted(self._split(fortunes))
+            for shard in shards:
+                self.drwlocks[shard].write_acquire_local()
+            try:
+                self.db.write_many(fortunes)
+                self.log.record(origin, seq, fortunes)
+            finally:
+                for shard in reversed(shards):
+                    self.drwlocks[shard].write_release_local()
+
+    def _catch_up(self):
+        """Fetch the writes we have missed from another replica.
+
+        The missed log entries are streamed in chunks. If the other
+        replica does not have them all in its log anymore, or if there
+        are more than catch_up_limit of them, a snapshot of its data is
+        copied first. Writes made meanwhile reach us as usual and are
+        applied in order with the fetched ones.
+
+        """
+
+        for pid in sorted(self.peer_list.get_peers().keys()):
+            try:
+                self._catch_up_from(self.peer_list.peer(pid))
+                return
+            except COMMUNICATION_ERRORS:
+                print("Peer {} does not respond, trying another "
+                      "one.".format(pid))
+
+    def _catch_up_from(self, peer):
+        max_gap = self.catch_up_limit
+        fetched = 0
+        while True:
+            answer = peer.log_since(self.log.expected_vector(),
+                                    CATCH_UP_CHUNK, max_gap)
+            if answer is None:
+                self._install_snapshot(peer)
+                # Whatever is left is replayed, however large.
+                max_gap = None
+                continue
+            entries, more = answer
+            for entry in entries:
+                self._apply(self.log.accept(*entry))
+            fetched += len(entries)
+            if not more:
+                break
+        print("Caught up, {} missed writes replayed.".format(fetched))
+
+    def _install_snapshot(self, peer):
+        """Replace our data with a copy of the data of peer."""
+
+        print("Copying a snapshot of another replica...")
+        vector, sizes, extras = peer.snapshot_begin()
+        files = database.shard_files(self.db_file, self.shards)
+        for shard, size in enumerate(sizes):
+            with open(files[shard] + ".snapshot", "wb") as data:
+                offset = 0
+                while offset < size:
+                    chunk = base64.b64decode(peer.snapshot_chunk(
+                        shard, offset, min(SNAPSHOT_CHUNK, size - offset)))
+                    data.write(chunk)
+                    offset += len(chunk)
+        for drwlock in self.drwlocks:
+            drwlock.write_acquire_local()
+        try:
+            # Our last snapshot is made of the files being replaced.
+            self.snapshot = None
+            for shard_file in files:
+                os.replace(shard_file + ".snapshot", shard_file)
+                if os.path.exists(shard_file + ".idx"):
+                    # The index journal describes the old data.
+                    os.remove(shard_file + ".idx")
+            self.db = database.Database(self.db_file, self.shards,
+                                        database.HASH, self.index)
+            for origin, seq, fortunes in self.log.install(vector, extras):
+                self.db.write_many(fortunes)
+                self.log.record(origin, seq, fortunes)
+        finally:
+            for drwlock in reversed(self.drwlocks):
+                drwlock.write_release_local()
+
+    def _take_snapshot(self, keep=False):
+        """Return a snapshot of our data, as [vector, sizes, extras].
+
+        The shard files are only appended to, so their first sizes
+        bytes hold the data at the time of the snapshot for as long as
+        they exist: the snapshot is taken without copying them, and the
+        local read locks are only held to read the vector and the sizes
+        together. If keep is set, it becomes our last snapshot.
+
+        """
+
+        self._read_acquire_local()
+        try:
+            files = database.shard_files(self.db_file, self.shards)
+            sizes = [os.path.getsize(f) if os.path.exists(f) else 0
+                     for f in files]
+            snapshot = [self.log.vector(), sizes, self.log.extras()]
+            if keep:
+                # Under the locks, so that _install_snapshot() cannot
+                # replace the files in between.
+                self.snapshot = snapshot
+            return snapshot
+        finally:
+            self._read_release_local()
+
+    def _snapshot_loop(self):
+        """Take a snapshot now and then and compact the log behind it."""
+
+        while not self.stopped.wait(self.snapshot_interval):
+            snapshot = self.snapshot
+            if snapshot is not None and snapshot[0] == self.log.vector():
+                # Nothing has been written since the last one.
+                continue
+            snapshot = self._take_snapshot(keep=True)
+            dropped = self.log.compact(snapshot[0])
+            if dropped:
+                print("Snapshot taken, {} log entries dropped.".format(
+                    dropped))
+
+    def _anti_entropy_loop(self):
+        while not self.stopped.wait(self.anti_entropy):
+            pids = list(self.peer_list.get_peers().keys())
+            if not pids:
+                continue
+            pid = rand.choice(pids)
+            try:
+                self._reconcile(pid, self.peer_list.peer(pid))
+            except (KeyError,) + COMMUNICATION_ERRORS:
+                # The replica has left, the next round picks another one.
+                pass
+
+    def _reconcile(self, pid, peer):
+        """Fetch the fortunes replica pid has and we miss.
+
+        The hash trees are compared from the root down, asking for the
+        children of the differing nodes only, then the records of the
+        differing buckets are exchanged. Replicas that have not applied
+        the same logged writes are not compared: the log is what brings
+        them in line, and a write on its way would be fetched twice.
+
+        """
+
+        tree = self.db.hash_tree()
+        vector = self.log.vector()
+        indexes = [1]
+        buckets = []
+        while indexes:
+            remote_vector, nodes = peer.tree_nodes(indexes)
+            if remote_vector != vector:
+                return
+            differing = [i for i, local, remote in zip(
+                indexes, tree.nodes(indexes), nodes) if local != remote]
+            buckets.extend(tree.bucket(i) for i in differing
+                           if tree.is_leaf(i))
+            indexes = [child for i in differing if not tree.is_leaf(i)
+                       for child in tree.children(i)]
+        if not buckets:
+            return
+        remote_vector, fortunes = peer.tree_records(buckets)
+        local_vector, local = self.tree_records(buckets)
+        if remote_vector != vector or local_vector != vector:
+            return
+        missing = list((collections.Counter(fortunes) -
+                        collections.Counter(local)).elements())
+        if not missing:
+            return
+        shards = sorted(self._split(missing))
+        for shard in shards:
+            self.drwlocks[shard].write_acquire_local()
+        try:
+            # These fortunes never went through the log, so they are
+            # not replayed to a joining replica, only copied with a
+            # snapshot.
+            self.db.write_many(missing)
+        finally:
+            for shard in reversed(shards):
+                self.drwlocks[shard].write_release_local()
+        print("Fetched {} fortunes missing here from server {}.".format(
+            len(missing), pid))
 
     # Public methods
 
     def destroy(self):
+        self.stopped.set()
         orb.Peer.destroy(self)
+        self.replicator.destroy()
         self.distributed_lock.destroy()
         self.peer_list.destroy()
 
@@ -109,46 +696,217 @@ class Server(orb.Peer):
 
     # Public methods
 
-    def read(self):
-        """Read a fortune from the database."""
+    def read(self, version=None, r=None):
+        """Read a fortune from the database.
+
+        version is a token returned by write(), or several of them
+        merged with merge_versions(). The read then sees these writes:
+        if this server has not applied them within session_wait
+        seconds, StaleReplica is raised with the id of a server that
+        has.
 
-        self.drwlock.read_acquire()
+        In the chain mode, the read is served by the tail. In the quorum
+        mode, it sees the latest version of r servers, or of the read
+        quorum of the server if r is None.
+
+        """
+
+        forwarded, fortune = self.replication.forward_read("read", version)
+        if forwarded:
+            return fortune
+        self._read_acquire(version, r)
         try:
             return self.db.read()
         finally:
-            self.drwlock.read_release()
+            self._read_release()
+
+    def read_many(self, n, unique=False, version=None, r=None):
+        """Read n random fortunes from the database in one call."""
+
+        forwarded, fortunes = self.replication.forward_read(
+            "read_many", n, unique, version)
+        if forwarded:
+            return fortunes
+        self._read_acquire(version, r)
+        try:
+            return self.db.read_many(n, unique)
+        finally:
+            self._read_release()
+
+    def search(self, query, limit=10, version=None, r=None):
+        """Return at most limit fortunes containing all words of query."""
 
-    def write(self, fortune):
+        forwarded, fortunes = self.replication.forward_read(
+            "search", query, limit, version)
+        if forwarded:
+            return fortunes
+        self._read_acquire(version, r)
+        try:
+            return self.db.search(query, limit)
+        finally:
+            self._read_release()
+
+    def write(self, fortune, w=None):
         """Write a fortune to the database.
 
-        Obtain the distributed lock and call all other servers to write
-        the fortune as well. Call their 'write_local' as they cannot
-        atempt to obtain the distributed lock when writting their
-        copies.
+        The write is committed as set by the replication mode, see
+        write_many(), and sent to the other servers as a logged write,
+        which they apply with 'write_many_local'.
+
+        Returns the version token of the write, for read(). In the quorum
+        mode, it returns once w servers have applied the write, or as
+        many as the write quorum of the server if w is None.
 
         """
 
-        self.drwlock.write_acquire()
-        self.db.write(fortune) # write the fortune locally
-        # distribute the update to all
-        peers = self.peer_list.get_peers().keys()
-        for peer in peers:
-            self.peer_list.peer(peer).write_local(fortune)
-        self.drwlock.write_release()
+        return self.replication.write(fortune, w)
 
-    def write_local(self, fortune):
-        """Write a fortune to the database.
+    def write_many(self, fortunes, w=None):
+        """Write a batch of fortunes to the database.
+
+        The fortunes are queued and the distributed lock is taken. The
+        lock holder applies and replicates everything queued so far in
+        a single 'write_many_local' call per server, so writes queued
+        behind the token are committed together with ours. With several
+        shards, every shard is committed under its own lock.
+
+        In the primary and chain modes, the writes are forwarded to the
+        primary, which commits them under its local locks instead. In
+        a chain, it returns once the tail has applied them. In the quorum
+        mode, this server commits them and waits for w servers, see
+        write().
+
+        """
+
+        return self.replication.write_many(list(fortunes), w)
+
+    def write_many_local(self, fortunes, origin, seq):
+        """Apply the write seq of server origin, a batch of fortunes.
 
         This method is called only by other servers once they've
-        obtained the distributed lock.
+        committed the write. It is applied in order with the other
+        writes of origin, and only once. If it is still waiting for an
+        earlier write of origin after session_wait seconds, NotApplied
+        is raised so that it does not count as acknowledged.
 
         """
 
-        self.drwlock.write_acquire_local()
+        self._apply(self.log.accept(origin, seq, fortunes))
+        # Another thread may be applying it, or it may wait for a
+        # write that has not reached us yet.
+        if self.log.wait_for([[origin, seq]],
+                             self.session_wait) is not None:
+            raise replicator.NotApplied(
+                "Write {} of server {} is not applied yet.".format(
+                    seq, origin))
+        return len(fortunes)
+
+    def tree_nodes(self, indexes):
+        """Return our log vector and nodes of our hash tree."""
+
+        vector = self.log.vector()
+        return [vector, self.db.hash_tree().nodes(indexes)]
+
+    def tree_records(self, buckets):
+        """Return our log vector and the fortunes in buckets.
+
+        A write is applied and logged under the local write locks, so
+        under the read locks the fortunes match the vector.
+
+        """
+
+        self._read_acquire_local()
         try:
-            self.db.write(fortune)
+            return [self.log.vector(), self.db.bucket_records(buckets)]
         finally:
-            self.drwlock.write_release_local()
+            self._read_release_local()
+
+    def replicate_batch(self, calls):
+        """Apply the updates a replica has queued for us, in order.
+
+        calls is a list of [method, args]. Returns, for every update, its
+        result as {"result": ...} or the error it raised as
+        {"error": {"name": ..., "args": ...}}, as orb answers a call:
+        an update that fails does not keep the next ones from being
+        applied.
+
+        """
+
+        results = []
+        for method, args in calls:
+            try:
+                results.append({"result": getattr(self, method)(*args)})
+            except Exception as e:
+                results.append({"error": {"name": e.__class__.__name__,
+                                          "args": e.args}})
+        return results
+
+    def log_vector(self):
+        """Return the vector of the writes we have applied."""
+
+        return self.log.vector()
+
+    def log_since(self, vector, limit, max_gap=None):
+        """Return the log entries a joining replica has missed.
+
+        See ReplicationLog.since(). None means that a snapshot is
+        needed.
+
+        """
+
+        return self.log.since(vector, limit, max_gap)
+
+    def snapshot_begin(self):
+        """Start copying our data to a joining replica.
+
+        Returns the vector of the writes in the data, the size of every
+        shard file and the log entries in the data beyond the vector,
+        see _take_snapshot(). With periodic snapshots, the last one is
+        returned: the log holds all the writes made since.
+
+        """
+
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self._take_snapshot(
+                keep=self.snapshot_interval is not None)
+        return snapshot
+
+    def snapshot_chunk(self, shard, offset, length):
+        """Return length bytes of a shard file, base64 encoded."""
+
+        shard_file = database.shard_files(self.db_file, self.shards)[shard]
+        with open(shard_file, "rb") as data:
+            data.seek(offset)
+            return base64.b64encode(data.read(length)).decode("ascii")
+
+    def call_counts(self):
+        """Return the remote calls this server has made, per method."""
+
+        return orb.call_counts()
+
+    def display_status(self):
+        """Print the status of the lock and of the replicas."""
+
+        self.replication.display_status()
+        if self.snapshot is not None:
+            print("Snapshot :: {} writes, {} entries left in the log".format(
+                sum(seq for _, seq in self.snapshot[0]),
+                len(self.log)))
+        self.distributed_lock.display_status()
+        self.replicator.display_status()
+
+    def revoke_lease(self, pid):
+        """Server pid is about to write: stop reading under our lease."""
+
+        if self.read_lease is not None:
+            self.read_lease.revoke(pid)
+
+    def grant_lease(self, pid):
+        """Server pid has applied its write on all the replicas."""
+
+        if self.read_lease is not None:
+            self.read_lease.grant(pid)
 
     def register_peer(self, pid, paddr):
         """Register a server peer in this server's peer list."""
@@ -161,6 +919,10 @@ class Server(orb.Peer):
 
         self.peer_list.unregister_peer(pid)
         self.distributed_lock.unregister_peer(pid)
+        self.replicator.unregister_peer(pid)
+        if self.read_lease is not None:
+            self.read_lease.forget(pid)
+        self.replication.peer_left(pid)
 
 # -----------------------------------------------------------------------------
 # The main program
@@ -168,7 +930,26 @@ class Server(orb.Peer):
 
 # Initialize the client object.
 local_address = (socket.gethostname(), local_port)
-p = Server(local_address, name_service_address, server_type, db_file)
+p = Server(local_address, name_service_address, server_type, db_file,
+           index=opts.index,
+           lease_writes=opts.lease_writes,
+           lease_time=opts.lease_time,
+           token_timeout=opts.token_timeout,
+           max_hold=opts.max_hold,
+           lock_engine=opts.lock,
+           shards=opts.shards,
+           read_lease=opts.read_lease,
+           ack=opts.ack,
+           failed=opts.failed,
+           catch_up_limit=opts.catch_up_limit,
+           batch_size=opts.batch_size,
+           batch_delay=opts.batch_delay,
+           session_wait=opts.session_wait,
+           mode=opts.mode,
+           anti_entropy=opts.anti_entropy,
+           snapshot_interval=opts.snapshot_interval,
+           read_quorum=opts.read_quorum,
+           write_quorum=opts.write_quorum)
 
 
 def menu():
@@ -0,0 +1,81 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""A local name service.
+
+It implements the protocol of the course name service, so that a group
+of peers can be run on a single machine without it:
+    --  register(type, address) -> [id, hash]
+    --  unregister(id, type, hash)
+    --  require_all(type) -> [[id, address], ...]
+    --  require_any(type) -> address
+    --  require_object(type, id) -> address
+
+Ids are given in increasing order, so a peer registering later always
+has a larger id than the ones already registered.
+
+"""
+
+import random
+import threading
+
+from . import orb
+
+
+class NameService(object):
+
+    """Registry of the objects of each type and their addresses."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.next_id = 0
+        self.rand = random.Random()
+        self.rand.seed()
+
+    # Public methods
+
+    def register(self, object_type, address):
+        with self.lock:
+            self.next_id += 1
+            object_hash = "{:032x}".format(self.rand.getrandbits(128))
+            self.objects.setdefault(object_type, {})[self.next_id] = (
+                list(address), object_hash)
+            return [self.next_id, object_hash]
+
+    def unregister(self, object_id, object_type, object_hash):
+        with self.lock:
+            objects = self.objects.get(object_type, {})
+            if object_id not in objects or \
+                    objects[object_id][1] != object_hash:
+                raise Exception("No object with id: '{}'".format(object_id))
+            del objects[object_id]
+
+    def require_all(self, object_type):
+        with self.lock:
+            objects = self.objects.get(object_type, {})
+            return [[oid, objects[oid][0]] for oid in sorted(objects)]
+
+    def require_any(self, object_type):
+        with self.lock:
+            objects = list(self.objects.get(object_type, {}).values())
+            if not objects:
+                raise Exception(
+                    "No object of type: '{}'".format(object_type))
+            return self.rand.choice(objects)[0]
+
+    def require_object(self, object_type, object_id):
+        with self.lock:
+            objects = self.objects.get(object_type, {})
+            if object_id not in objects:
+                raise Exception("No object with id: '{}'".format(object_id))
+            return objects[object_id][0]
+
+
+def start(address):
+    """Serve a new NameService at address. Returns the service."""
+    name_service = NameService()
+    skeleton = orb.Skeleton(name_service, address)
+    skeleton.start()
+    return name_service
@@ -10,8 +10,16 @@
 """ Simple module to obtain the name service location.
 
 This module's role is simply to allow easy maintenance of the lab
-structure if the name service changes address.
+structure if the name service changes address. The address can be
+overridden with the NAME_SERVICE environment variable, e.g.,
+NAME_SERVICE=127.0.0.1:42424, to use a local name service.
 
 """
 
+import os
+
 name_service_address = ("chipolata2.ida.liu.se", 42424)
+
+if "NAME_SERVICE" in os.environ:
+    host, port = os.environ["NAME_SERVICE"].rsplit(":", 1)
+    name_service_address = (host, int(port))
@@ -10,6 +10,7 @@
 import threading
 import socket
 import json
+import collections
 #import builtins
 
 """Object Request Broker
@@ -35,6 +36,22 @@ class ComunicationError(Exception):
     pass
 
 
+# Errors showing that a remote object could not be reached, as opposed
+# to errors raised by the remote method itself.
+COMMUNICATION_ERRORS = (OSError, ComunicationError)
+
+
+# Number of remote calls made by the stubs of this process, per method.
+calls = collections.Counter()
+calls_lock = threading.Lock()
+
+
+def call_counts():
+    """Return the number of remote calls made so far, per method."""
+    with calls_lock:
+        return dict(calls)
+
+
 class Stub(object):
 
     """ Stub for generic objects distributed over the network.
@@ -52,6 +69,8 @@ class Stub(object):
         #
         # should parse and send json requests and send these to skeleton of the requested peer
         message = json.dumps({"method": method, "args": args})
+        with calls_lock:
+            calls[method] += 1
         # for serialized json
         message += "\n"
         try:
@@ -60,7 +79,12 @@ class Stub(object):
             data = transmission_socket.makefile(mode="rw")
             data.write(message)
             data.flush()
-            result = json.loads(data.readline())
+            reply = data.readline()
+            try:
+                result = json.loads(reply)
+            except ValueError:
+                # The peer went away before it could answer.
+                raise ComunicationError("Bad reply", reply)
             data.flush()
             transmission_socket.close()
             if 'error' in result:
@@ -143,8 +167,9 @@ class Skeleton(threading.Thread):
         # create a socket? and pass? connect before send?
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind(address)
-        # The argument to listen() is just for protection from multiple requests
-        self.server_socket.listen(1)
+        # Peers connect concurrently (one connection per call), so a short
+        # backlog would drop connections and stall them on SYN retries.
+        self.server_socket.listen(socket.SOMAXCONN)
         
         #self.request = Request(self, s, address)
         
@@ -0,0 +1,202 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Client-side routing of remote calls over a set of replicas.
+
+A ReplicaRouter is used like an orb.Stub, but stands for all the objects
+of a type registered with the name service. Every call goes to the
+healthy replica with the lowest latency, measured as an exponentially
+weighted moving average (EWMA) of its past calls. Replicas never used
+yet count as the fastest, so every replica is tried at least once.
+
+A replica that cannot be reached is marked as down for a time doubling
+with every consecutive failure, and the call is retried on the next
+best replica:
+    --  read calls are retried on every replica,
+    --  other calls are only retried if the connection was refused,
+        i.e., if the failed replica cannot have run them.
+
+Read calls slower than hedge_after seconds are also sent to the second
+best replica and the first answer wins. Errors raised by the remote
+method itself are not retried.
+
+"""
+
+import time
+import threading
+import concurrent.futures
+
+from . import orb
+
+# Calls that only read and can be repeated on another replica.
+READS = ("read", "read_many", "search")
+
+
+class _Replica(object):
+
+    """A replica and what is known of its health."""
+
+    def __init__(self, rid, address):
+        self.id = rid
+        self.stub = orb.Stub(address)
+        self.latency = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.down_until = 0
+
+
+class ReplicaRouter(object):
+
+    """Stub-like object routing calls to the replicas of a type.
+
+    Public methods:
+        --  __init__(name_service, object_type, reads=READS,
+                     hedge_after=None, alpha=0.2, down_time=0.5,
+                     max_down_time=30.0, refresh_interval=10.0)
+        --  replicas()
+        --  <any method of the replicas>
+
+    """
+
+    def __init__(self, name_service, object_type, reads=READS,
+                 hedge_after=None, alpha=0.2, down_time=0.5,
+                 max_down_time=30.0, refresh_interval=10.0):
+        self.name_service = name_service
+        self.object_type = object_type
+        self.reads = set(reads)
+        self.hedge_after = hedge_after
+        self.alpha = alpha
+        self.down_time = down_time
+        self.max_down_time = max_down_time
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.members = {}
+        self.refreshed = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(4)
+        self._refresh()
+
+    # Private methods
+
+    def _refresh(self):
+        """Update the replica set from the name service."""
+        try:
+            objects = self.name_service.require_all(self.object_type)
+        except orb.COMMUNICATION_ERRORS:
+            # Keep routing to the replicas we know of.
+            return
+        with self.lock:
+            members = {}
+            for rid, address in objects:
+                replica = self.members.get(rid)
+                if replica is None or replica.stub.address != tuple(address):
+                    replica = _Replica(rid, address)
+                members[rid] = replica
+            self.members = members
+            self.refreshed = time.monotonic()
+
+    def _ranked(self, skip):
+        """Return the replicas not in skip, the best ones first."""
+        if time.monotonic() - self.refreshed > self.refresh_interval:
+            self._refresh()
+        now = time.monotonic()
+        with self.lock:
+            replicas = [r for r in self.members.values() if r.id not in skip]
+            # The replicas that are down come last, the ones that should
+            # be up again soonest first.
+            return sorted(replicas, key=lambda r: (
+                max(r.down_until, now), r.latency))
+
+    def _succeeded(self, replica, latency):
+        with self.lock:
+            if replica.calls == 0:
+                replica.latency = latency
+            else:
+                replica.latency += self.alpha * (latency - replica.latency)
+            replica.calls += 1
+            replica.failures = 0
+            replica.down_until = 0
+
+    def _failed(self, replica):
+        with self.lock:
+            replica.failures += 1
+            replica.down_until = time.monotonic() + min(
+                self.max_down_time,
+                self.down_time * 2 ** (replica.failures - 1))
+
+    def _timed(self, replica, method, args):
+        """Call method on replica, updating its health."""
+        start = time.monotonic()
+        try:
+            result = getattr(replica.stub, method)(*args)
+        except orb.COMMUNICATION_ERRORS:
+            self._failed(replica)
+            raise
+        except Exception:
+            # The replica answered, with an error of the method.
+            self._succeeded(replica, time.monotonic() - start)
+            raise
+        self._succeeded(replica, time.monotonic() - start)
+        return result
+
+    def _hedged(self, replicas, method, args, tried):
+        """Call method on the first replica, and on the second if slow."""
+        first = self.executor.submit(self._timed, replicas[0], method, args)
+        done, _ = concurrent.futures.wait([first], self.hedge_after)
+        if done:
+            return first.result()
+        tried.add(replicas[1].id)
+        second = self.executor.submit(self._timed, replicas[1], method, args)
+        error = None
+        for future in concurrent.futures.as_completed([first, second]):
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+            if not isinstance(error, orb.COMMUNICATION_ERRORS):
+                raise error
+        raise error
+
+    def _call(self, method, *args):
+        read = method in self.reads
+        tried = set()
+        error = None
+        refreshed = False
+        while True:
+            replicas = self._ranked(tried)
+            if not replicas and not refreshed:
+                # Look for replicas that have joined meanwhile.
+                self._refresh()
+                refreshed = True
+                continue
+            if not replicas:
+                if error is None:
+                    raise orb.ComunicationError(
+                        "No replica of type '{}'".format(self.object_type))
+                raise error
+            if read and self.hedge_after is not None:
+                replicas = replicas[:2]
+            else:
+                replicas = replicas[:1]
+            tried.add(replicas[0].id)
+            try:
+                if len(replicas) > 1:
+                    return self._hedged(replicas, method, args, tried)
+                return self._timed(replicas[0], method, args)
+            except orb.COMMUNICATION_ERRORS as e:
+                if not read and not isinstance(e, ConnectionRefusedError):
+                    raise
+                error = e
+
+    # Public methods
+
+    def replicas(self):
+        """Return [id, address, latency, failures] for every replica."""
+        with self.lock:
+            return [[r.id, r.stub.address, r.latency, r.failures]
+                    for _, r in sorted(self.members.items())]
+
+    def __getattr__(self, attr):
+        """Forward call to the best replica."""
+        def rmi_call(*args):
+            return self._call(attr, *args)
+        return rmi_call
@@ -23,11 +23,25 @@ The implementation should satisfy the following requests:
         dictionaries should be updated acordingly.
     --  when the peer that has the token (either TOKEN_PRESENT or
         TOKEN_HELD) quits, it should pass the token to some other peer.
-    --  For simplicity, we shall not handle the case when the peer
-        holding the token dies unexpectedly.
+
+Optionally, the lock also recovers from the death of the token holder:
+    --  a peer that has waited token_timeout seconds for the token asks
+        every peer for its status (token_status). If, twice in a row,
+        no living peer has the token, the token is considered lost.
+    --  the living peer with the smallest id is elected and rebuilds
+        the token (regenerate_token). For every peer, it takes the
+        latest time stamp known by any survivor, so that satisfied
+        requests are not served twice and pending ones are not lost.
+    --  a peer may hold the lock for at most max_hold seconds; after
+        that the lock is taken away and passed to the next requester.
 
 """
 
+import time
+import threading
+
+from ..peerList import COMMUNICATION_ERRORS
+
 NO_TOKEN = 0
 TOKEN_PRESENT = 1
 TOKEN_HELD = 2
@@ -38,26 +52,41 @@ class DistributedLock(object):
     """Implementation of distributed mutual exclusion for a list of peers.
 
     Public methods:
-        --  __init__(owner, peer_list)
+        --  __init__(owner, peer_list, token_timeout=None, max_hold=None)
         --  initialize()
         --  destroy()
         --  register_peer(pid)
         --  unregister_peer(pid)
-        --  acquire()
+        --  acquire(timeout=None)
+        --  cancel()
         --  release()
+        --  has_requests()
         --  request_token(time, pid)
         --  obtain_token(token)
+        --  token_status()
+        --  regenerate_token(tokens)
+        --  give_token(pid)
+        --  is_held()
+        --  remote_calls()
         --  display_status()
 
     """
 
-    def __init__(self, owner, peer_list):
+    def __init__(self, owner, peer_list, token_timeout=None, max_hold=None):
         self.peer_list = peer_list
         self.owner = owner
         self.time = 0
         self.token = None
         self.request = {}
         self.state = NO_TOKEN
+        self.waiting = False
+        self.cancelled = False
+        # Token loss recovery.
+        self.token_timeout = token_timeout
+        self.max_hold = max_hold
+        self.last_token = {}
+        self.regenerated_at = None
+        self.hold_count = 0
 
     def _prepare(self, token):
         """Prepare the token to be sent as a JSON message.
@@ -72,6 +101,100 @@ class DistributedLock(object):
         """The reverse operation to the one above."""
         return dict(token)
 
+    def _pass_token(self, anyone=False):
+        """Pass the token to the next peer that has requested it.
+
+        The peers are scanned in increasing id order starting right
+        after our own id and wrapping around, which ensures fairness.
+        With anyone set, the token is given to the next peer even if
+        nobody has requested it. Peers that cannot be reached are
+        removed and skipped. Must be called with peer_list.lock held
+        while the token is present. Returns True if the token was
+        passed on.
+
+        """
+        sorted_list = sorted(self.request.items())
+        after = [(i, t) for i, t in sorted_list if i > self.owner.id]
+        before = [(i, t) for i, t in sorted_list if i < self.owner.id]
+        for request_id, request_time in after + before:
+            if anyone or self.token.get(request_id, 0) < request_time:
+                if self._send_token(request_id):
+                    return True
+        return False
+
+    def _send_token(self, pid):
+        """Send the token to peer pid. Returns True if it was sent.
+
+        Must be called with peer_list.lock held while the token is
+        present. A peer that cannot be reached is removed.
+
+        """
+        self.token[self.owner.id] = self.time
+        self.last_token = dict(self.token)
+        try:
+            self.peer_list.peer(pid).obtain_token(self._prepare(self.token))
+        except COMMUNICATION_ERRORS:
+            self._drop_peers([pid])
+            return False
+        self.state = NO_TOKEN
+        self.token = None
+        return True
+
+    def _take(self):
+        """Mark the token as held and start the hold timer, if any."""
+        self.state = TOKEN_HELD
+        self.hold_count += 1
+        if self.max_hold is not None:
+            timer = threading.Timer(self.max_hold, self._expire_hold,
+                                    (self.hold_count,))
+            timer.daemon = True
+            timer.start()
+
+    def _expire_hold(self, hold):
+        """Take the lock away from a holder that kept it too long."""
+        self.peer_list.lock.acquire()
+        try:
+            if self.state == TOKEN_HELD and self.hold_count == hold:
+                print("The lock was held for more than {} seconds, "
+                      "releasing it.".format(self.max_hold))
+                self.state = TOKEN_PRESENT
+                self._pass_token()
+        finally:
+            self.peer_list.lock.release()
+
+    def _recover(self):
+        """Check whether the token is lost and have it regenerated.
+
+        Called by a peer that has waited too long for the token.
+
+        """
+        print("No token after {} seconds, looking for it...".format(
+            self.token_timeout))
+        for attempt in range(2):
+            if attempt > 0:
+                # Let token transfers that were in flight complete.
+                time.sleep(min(self.token_timeout, 1.0))
+            statuses, failed = self.peer_list.broadcast("token_status")
+            self._drop_peers(failed)
+            if self.state != NO_TOKEN or any(
+                    state != NO_TOKEN for state, _ in statuses.values()):
+                return
+        tokens = [token for _, token in statuses.values() if token]
+        elected = min(list(statuses.keys()) + [self.owner.id])
+        print("The token is lost, peer {} regenerates it.".format(elected))
+        if elected == self.owner.id:
+            self.regenerate_token(tokens)
+        else:
+            try:
+                self.peer_list.peer(elected).regenerate_token(tokens)
+            except COMMUNICATION_ERRORS:
+                self._drop_peers([elected])
+
+    def _drop_peers(self, pids):
+        """Unregister the peers that could not be reached."""
+        for pid in pids:
+            self.peer_list.drop(pid)
+
     # Public methods
 
     def initialize(self):
@@ -122,33 +245,12 @@ class DistributedLock(object):
         self.peer_list.lock.acquire()
         try:
             peers = self.peer_list.get_peers().keys()
-            print(peers)
             # If there exist other peers and we have the token
             if len(peers) > 0 and self.state == TOKEN_PRESENT:
-                sorted_list = sorted(self.request.items())
-                got_result = False
-                # Should probably put this in a seperate function
-                # Loop through the peers and see which peers have issued new requests
-                # Ids higher than us i+1,i+2,...,n
-                for request_id,request_time in sorted_list:
-                    if request_id > self.owner.id and self.token[request_id] < request_time:
-                        self.state = NO_TOKEN
-                        self.token[self.owner.id] = self.time
-                        self.peer_list.peer(request_id).obtain_token(self._prepare(self.token))
-                        self.token = None
-                        got_result = True
-                        break
-                # Ids lower than us 1,2,...,i-2,i-1
-                if got_result == False:
-                    for request_id,request_time in sorted_list:
-                        if request_id < self.owner.id and self.token[request_id] < request_time:
-                            self.state = NO_TOKEN
-                            self.token[self.owner.id] = self.time
-                            self.peer_list.peer(request_id).obtain_token(self._prepare(self.token))
-                            self.token = None
-                            break
-                        elif request_id >= self.owner.id:
-                            break
+                # Nobody may be waiting, but the token must not leave
+                # the system with us.
+                if not self._pass_token():
+                    self._pass_token(anyone=True)
         finally:
             self.peer_list.lock.release()
 
@@ -183,8 +285,16 @@ class DistributedLock(object):
         finally:
             self.peer_list.lock.release()
 
-    def acquire(self):
-        """Called when this object tries to acquire the lock."""
+    def acquire(self, timeout=None):
+        """Called when this object tries to acquire the lock.
+
+        If the token is not present, the other peers are asked for it
+        and the caller sleeps on the peer_list condition until
+        obtain_token wakes it up. With a timeout (in seconds), or if
+        cancel() is called meanwhile, the wait may end without the
+        lock. Returns True if the lock was acquired, False otherwise.
+
+        """
         print("Trying to acquire the lock...")
         #
         # Your code here.
@@ -195,25 +305,62 @@ class DistributedLock(object):
         self.peer_list.lock.acquire()
         try:
             self.time += 1
+            self.cancelled = False
             if self.state == TOKEN_PRESENT:
-                self.state = TOKEN_HELD
-                return
+                self._take()
+                return True
+            self.waiting = True
+            request_time = self.time
         finally:
             self.peer_list.lock.release()
 
-        peers = self.peer_list.get_peers().keys()
-        for peer_id in peers:
-            if peer_id == self.owner.id:
-                continue
-            self.peer_list.peer(peer_id).request_token(self.time, self.owner.id)
+        # Ask all the other peers for the token in parallel.
+        _, failed = self.peer_list.broadcast("request_token", request_time,
+                                             self.owner.id)
+        self._drop_peers(failed)
 
-        while self.state == NO_TOKEN:
-            pass
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        self.peer_list.lock.acquire()
+        try:
+            while self.state == NO_TOKEN and not self.cancelled:
+                wait = self.token_timeout
+                if timeout is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if wait is None or remaining < wait:
+                        wait = remaining
+                recover = (self.token_timeout is not None and
+                           wait == self.token_timeout)
+                if (not self.peer_list.lock.wait(wait) and recover and
+                        self.state == NO_TOKEN):
+                    # The status queries must not hold our lock, or a
+                    # peer passing us the token would block on it.
+                    self.peer_list.lock.release()
+                    try:
+                        self._recover()
+                    finally:
+                        self.peer_list.lock.acquire()
+            self.waiting = False
+            if self.state == NO_TOKEN:
+                print("Gave up waiting for the token")
+                return False
+            if self.state != TOKEN_HELD:
+                self._take()
+            print("Got token")
+            return True
+        finally:
+            self.peer_list.lock.release()
 
+    def cancel(self):
+        """Wake up a pending acquire() and make it give up."""
         self.peer_list.lock.acquire()
-        self.state = TOKEN_HELD
-        print("Got token")
-        self.peer_list.lock.release()
+        try:
+            self.cancelled = True
+            self.peer_list.lock.notify_all()
+        finally:
+            self.peer_list.lock.release()
 
     def release(self):
         """Called when this object releases the lock."""
@@ -226,36 +373,21 @@ class DistributedLock(object):
         #of them (carefully think through to whom in order to ensure fairness).
         self.peer_list.lock.acquire()
         try:
-            print("1")
             if self.state != NO_TOKEN and len(self.request) > 0:
                 self.state = TOKEN_PRESENT
-                got_result = False
-                print("2")
-                sorted_list = sorted(self.request.items())
-                # Loop through the peers and see which peers have issued new requests
-                # Ids higher than us i+1,i+2,...,n
-                for request_id,request_time in sorted_list:
-                    if request_id > self.owner.id and self.token[request_id] < request_time:
-                        self.state = NO_TOKEN
-                        self.token[self.owner.id] = self.time
-                        self.peer_list.peer(request_id).obtain_token(self._prepare(self.token))
-                        self.token = None
-                        got_result = True
-                        break
+                self._pass_token()
+        finally:
+            self.peer_list.lock.release()
 
-                # Ids lower than us 1,2,...,i-2,i-1
-                print("3")
-                if got_result == False:
-                    for request_id,request_time in sorted_list:
-                        if request_id < self.owner.id and self.token[request_id] < request_time:
-                            self.state = NO_TOKEN
-                            self.token[self.owner.id] = self.time
-                            self.peer_list.peer(request_id).obtain_token(self._prepare(self.token))
-                            self.token = None
-                            break
-                        elif request_id >= self.owner.id:
-                            break
-                print("4")
+    def has_requests(self):
+        """Return True if another peer is waiting for our token."""
+        self.peer_list.lock.acquire()
+        try:
+            if self.token is None:
+                return False
+            return any(self.token.get(pid, 0) < request_time
+                       for pid, request_time in self.request.items()
+                       if pid != self.owner.id)
         finally:
             self.peer_list.lock.release()
 
@@ -266,22 +398,20 @@ class DistributedLock(object):
         #
         # called when some other peer requests the token from
         # the current peer (should the current one have the token or not).
-        print("deadlock?")
         self.peer_list.lock.acquire()
         try:
-            print("No")
             # add the request to the list, potential risk of simultanous access, needs to be locked
             # Updates the time if needed (if the request time is greater than the internal time)
             self.time = max(self.time, time)
             # Updates the request list if needed with the new time
-            self.request[pid] = max(self.request[pid], time)
-
+            self.request[pid] = max(self.request.get(pid, 0), time)
+            # The state must be checked under the lock, or the token
+            # could be taken from a peer that has just acquired it.
+            if self.state == TOKEN_PRESENT:
+                self._pass_token()
         finally:
             self.peer_list.lock.release()
 
-        if self.state == TOKEN_PRESENT:
-            self.release()
-
 
     def obtain_token(self, token):
         """Called when some other object is giving us the token."""
@@ -289,16 +419,97 @@ class DistributedLock(object):
         #
         # Your code here.
         #
-        print(token)
         self.peer_list.lock.acquire()
         try:
-            print("locked?")
             self.token = self._unprepare(token)
-            print("after acquire")
-            self.state = TOKEN_PRESENT
+            self.last_token = dict(self.token)
+            if self.waiting:
+                # Hand the lock directly to the waiting acquire(), so
+                # that a request arriving before it wakes up cannot
+                # take the token away.
+                self._take()
+                self.peer_list.lock.notify_all()
+            else:
+                self.state = TOKEN_PRESENT
+                # Nobody waits for the token anymore (the acquire has
+                # timed out or was cancelled), so hand it on.
+                self._pass_token()
+        finally:
+            self.peer_list.lock.release()
+
+    def token_status(self):
+        """Return our state and the latest token we have seen."""
+        self.peer_list.lock.acquire()
+        try:
+            token = self.token if self.token is not None else self.last_token
+            return [self.state, self._prepare(token)]
+        finally:
+            self.peer_list.lock.release()
+
+    def regenerate_token(self, tokens):
+        """Rebuild a lost token from the tokens seen by the survivors.
+
+        Called on the peer elected by _recover(). Requests to regenerate
+        the token again shortly after it was done are ignored, since
+        they come from peers that detected the same loss.
+
+        """
+        self.peer_list.lock.acquire()
+        try:
+            if self.state != NO_TOKEN:
+                return
+            now = time.monotonic()
+            window = self.token_timeout or 0
+            if (self.regenerated_at is not None and
+                    now - self.regenerated_at < window):
+                return
+            self.regenerated_at = now
+            print("Regenerating the lost token...")
+            token = dict((pid, 0) for pid in self.request)
+            for seen in [self._prepare(self.last_token)] + list(tokens):
+                for pid, t in self._unprepare(seen).items():
+                    if pid in token:
+                        token[pid] = max(token[pid], t)
+            self.token = token
+            self.last_token = dict(token)
+            if self.waiting:
+                self._take()
+                self.peer_list.lock.notify_all()
+            else:
+                self.state = TOKEN_PRESENT
+                self._pass_token()
         finally:
             self.peer_list.lock.release()
-            print("obtain_token(): Released lock")
+
+    def give_token(self, pid):
+        """Send an unused token to peer pid.
+
+        The token is only sent if it is present, nobody waits for it
+        here and no other peer has requested it. Returns True if the
+        token was sent.
+
+        """
+        self.peer_list.lock.acquire()
+        try:
+            if (self.state != TOKEN_PRESENT or self.waiting or
+                    pid == self.owner.id or self.has_requests()):
+                return False
+            return self._send_token(pid)
+        finally:
+            self.peer_list.lock.release()
+
+    def is_held(self):
+        """Return True if this peer currently holds the lock."""
+        return self.state == TOKEN_HELD
+
+    def remote_calls(self):
+        """Return the methods the owner must make callable by peers."""
+        return {
+            "request_token":      self.request_token,
+            "obtain_token":       self.obtain_token,
+            "token_status":       self.token_status,
+            "regenerate_token":   self.regenerate_token,
+        }
 
     def display_status(self):
         """Print the status of this peer."""
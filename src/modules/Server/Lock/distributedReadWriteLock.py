@@ -9,16 +9,44 @@
 
 """Class implementing a distributed version of ReadWriteLock."""
 
+import time
 import threading
 from . import readWriteLock
 
 
-class DistributedReadWriteLock(readWriteLock.ReadWriteLock):
+class LockRevoked(Exception):
 
-    """Distributed version of ReadWriteLock."""
+    """The distributed lock was taken away before the write was done."""
 
-    def __init__(self, distributed_lock):
-        readWriteLock.ReadWriteLock.__init__(self)
+    pass
+
+
+class DistributedReadWriteLock(readWriteLock.StripedReadWriteLock):
+
+    """Distributed version of ReadWriteLock.
+
+    The local side is a StripedReadWriteLock following policy, so local
+    reads do not contend on a single mutex.
+
+    In lease mode (lease_writes > 1), a writer that releases the lock
+    keeps the distributed token as long as other local writers are
+    queued, up to lease_writes writes or lease_time seconds, and as
+    long as no other peer has requested the token. A burst of local
+    writes then costs a single token round instead of one per write.
+
+    If the distributed lock is taken away from a writer, see max_hold in
+    DistributedLock, the lease ends. A writer calls begin_commit() right
+    before it changes the data: if the lock is gone by then, nothing
+    must be written, and write_release() raises LockRevoked. Once the
+    commit has begun, the write is done under the lock and
+    write_release() does not raise, even if the lock is taken away
+    while the write is being applied.
+
+    """
+
+    def __init__(self, distributed_lock, stripes=None, lease_writes=1,
+                 lease_time=1.0, policy=readWriteLock.WRITER_PREFERRING):
+        readWriteLock.StripedReadWriteLock.__init__(self, stripes, policy)
         # Create a distributed lock
         self.distributed_lock = distributed_lock
         #
@@ -26,6 +54,29 @@ class DistributedReadWriteLock(readWriteLock.ReadWriteLock):
         #
 
         self.global_lock = threading.Lock()
+        self.lease_writes = lease_writes
+        self.lease_time = lease_time
+        self.leased = False
+        # Whether the current writer has begun to commit, see
+        # begin_commit().
+        self.committing = False
+        self.lease_start = 0
+        self.lease_count = 0
+        self.queued_writers = 0
+        self.queue_lock = threading.Lock()
+
+    # Private methods
+
+    def _keep_lease(self):
+        """Decide whether the token is kept for the next local writer."""
+        if self.lease_writes <= 1 or self.lease_count >= self.lease_writes:
+            return False
+        if time.monotonic() - self.lease_start >= self.lease_time:
+            return False
+        with self.queue_lock:
+            if self.queued_writers == 0:
+                return False
+        return not self.distributed_lock.has_requests()
 
     # Public methods
 
@@ -33,27 +84,64 @@ class DistributedReadWriteLock(readWriteLock.ReadWriteLock):
         """Acquire the rights to write into the database.
 
         Override the write_acquire method to include obtaining access
-        to the rest of the peers.
+        to the rest of the peers, unless the previous local writer has
+        kept the token for us.
 
         """
+        with self.queue_lock:
+            self.queued_writers += 1
         self.global_lock.acquire()
-        self.distributed_lock.acquire()
+        with self.queue_lock:
+            self.queued_writers -= 1
+        if not (self.leased and self.distributed_lock.is_held()):
+            # Without the lease, or if the lock was taken away from the
+            # previous writer, ask for the token again.
+            self.distributed_lock.acquire()
+            self.leased = True
+            self.lease_start = time.monotonic()
+            self.lease_count = 0
+        self.lease_count += 1
+        self.committing = False
         self.write_acquire_local()
 
     def write_release(self):
         """Release the rights to write into the database.
 
         Override the write_release method to include releasing access
-        to the rest of the peers.
+        to the rest of the peers, unless the token is kept for a queued
+        local writer.
 
         """
-
-        self.global_lock.release()
-        self.distributed_lock.release()
         self.write_release_local()
+        revoked = not self.distributed_lock.is_held()
+        if revoked:
+            # The token has already been passed on.
+            self.leased = False
+        elif not self._keep_lease():
+            self.leased = False
+            self.distributed_lock.release()
+        revoked = revoked and not self.committing
+        self.global_lock.release()
+        if revoked:
+            raise LockRevoked("The distributed lock was taken away before "
+                              "the write was committed.")
+
+    def begin_commit(self):
+        """Tell that the writer is about to change the data.
+
+        Returns False if the distributed lock has been taken away, in
+        which case nothing must be written.
+
+        """
+        self.committing = self.distributed_lock.is_held()
+        return self.committing
+
+    def is_held(self):
+        """Return True if this peer holds the distributed lock."""
+        return self.distributed_lock.is_held()
 
     def write_acquire_local(self):
-        readWriteLock.ReadWriteLock.write_acquire(self)
+        readWriteLock.StripedReadWriteLock.write_acquire(self)
 
     def write_release_local(self):
-        readWriteLock.ReadWriteLock.write_release(self)
+        readWriteLock.StripedReadWriteLock.write_release(self)
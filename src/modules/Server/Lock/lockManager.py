@@ -0,0 +1,357 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Module for many named distributed locks over a single peer list.
+
+Every name (key) has its own token, handled by its own DistributedLock,
+so critical sections on different keys run in parallel across the
+system. All the locks share the peer list and its connections: their
+remote calls go through a handful of 'lock_*' methods of the owner that
+carry the key as first argument.
+
+The lock of a key is created the first time the key is used on a peer,
+either locally or by a remote call. As in DistributedLock, the token of
+a new key starts at the peer with the smallest id, its home. Locks that
+have not been used for idle_time seconds are garbage-collected:
+    --  a peer that has an unused token sends it back to its home,
+    --  the home of an unused token asks every peer to forget the key
+        (lock_forget). A peer agrees if it does not want the token and
+        has no request that the token has not served yet. If all peers
+        agree, the home forgets the key as well, since its next lock
+        will start with the token there again.
+A peer that forgets a key keeps its clock, so the requests of its next
+lock for the key are never taken for already served ones.
+
+"""
+
+import time
+import threading
+
+from .distributedLock import DistributedLock, NO_TOKEN, TOKEN_PRESENT
+
+
+class _KeyedStub(object):
+
+    """Stub of a peer that routes the calls of the lock of one key."""
+
+    def __init__(self, stub, key):
+        self.stub = stub
+        self.key = key
+
+    def __getattr__(self, attr):
+        method = getattr(self.stub, "lock_" + attr)
+
+        def keyed_call(*args):
+            return method(self.key, *args)
+
+        return keyed_call
+
+
+class _KeyedPeerList(object):
+
+    """The peer list as seen by the lock of one key.
+
+    The peers and their stubs are shared, but every key has its own
+    state lock, so that passing the token of a key never waits for
+    the lock of another key.
+
+    """
+
+    def __init__(self, peer_list, key):
+        self.peer_list = peer_list
+        self.key = key
+        self.lock = threading.Condition()
+
+    def get_peers(self):
+        return self.peer_list.get_peers()
+
+    def peer(self, pid):
+        return _KeyedStub(self.peer_list.peer(pid), self.key)
+
+    def broadcast(self, method, *args, pids=None):
+        return self.peer_list.broadcast("lock_" + method, self.key, *args,
+                                        pids=pids)
+
+
+class _Entry(object):
+
+    """The lock of a key and its bookkeeping."""
+
+    def __init__(self, lock):
+        self.lock = lock
+        # Local threads acquiring or holding the lock.
+        self.users = 0
+        self.used = time.monotonic()
+        self.retired = False
+
+
+class NamedLock(object):
+
+    """Handle on the lock of one key, usable as a DistributedLock."""
+
+    def __init__(self, manager, key):
+        self.manager = manager
+        self.key = key
+
+    def acquire(self, timeout=None):
+        return self.manager.acquire(self.key, timeout)
+
+    def release(self):
+        self.manager.release(self.key)
+
+    def has_requests(self):
+        return self.manager.has_requests(self.key)
+
+    def is_held(self):
+        return self.manager.is_held(self.key)
+
+
+class LockManager(object):
+
+    """Manager of named distributed locks for a list of peers.
+
+    Public methods:
+        --  __init__(owner, peer_list, token_timeout=None, max_hold=None,
+                     idle_time=30.0)
+        --  initialize()
+        --  destroy()
+        --  register_peer(pid)
+        --  unregister_peer(pid)
+        --  get_lock(key)
+        --  acquire(key, timeout=None)
+        --  release(key)
+        --  has_requests(key)
+        --  is_held(key)
+        --  remote_calls()
+        --  display_status()
+
+    and the remote methods lock_request_token, lock_obtain_token,
+    lock_token_status, lock_regenerate_token and lock_forget.
+
+    """
+
+    def __init__(self, owner, peer_list, token_timeout=None, max_hold=None,
+                 idle_time=30.0):
+        self.owner = owner
+        self.peer_list = peer_list
+        self.token_timeout = token_timeout
+        self.max_hold = max_hold
+        self.idle_time = idle_time
+        self.lock = threading.Lock()
+        self.locks = {}
+        # The largest time stamp of the forgotten locks.
+        self.clock = 0
+        self.stopped = threading.Event()
+        self.collector = threading.Thread(target=self._collect_loop)
+        self.collector.daemon = True
+
+    # Private methods
+
+    def _entry(self, key):
+        """Return the entry of key, creating its lock if needed.
+
+        Must be called with self.lock held.
+
+        """
+        entry = self.locks.get(key)
+        if entry is None:
+            lock = DistributedLock(self.owner,
+                                   _KeyedPeerList(self.peer_list, key),
+                                   self.token_timeout, self.max_hold)
+            lock.time = self.clock
+            lock.initialize()
+            entry = _Entry(lock)
+            self.locks[key] = entry
+        entry.used = time.monotonic()
+        return entry
+
+    def _retire(self, key, entry):
+        """Forget the lock of key. Must be called with self.lock held."""
+        entry.retired = True
+        del self.locks[key]
+        self.clock = max(self.clock, entry.lock.time)
+
+    def _remote(self, key, method, *args):
+        """Call a method of the lock of key on behalf of a peer."""
+        while True:
+            with self.lock:
+                entry = self._entry(key)
+            with entry.lock.peer_list.lock:
+                # The lock may have been forgotten while we waited.
+                if not entry.retired:
+                    return getattr(entry.lock, method)(*args)
+
+    def _collect_loop(self):
+        while not self.stopped.wait(self.idle_time / 2):
+            with self.lock:
+                keys = list(self.locks.keys())
+            for key in keys:
+                self._collect(key)
+
+    def _collect(self, key):
+        """Garbage-collect the lock of key if it is not used anymore."""
+        with self.lock:
+            entry = self.locks.get(key)
+            if (entry is None or entry.users > 0 or
+                    time.monotonic() - entry.used < self.idle_time):
+                return
+        lock = entry.lock
+        if lock.state != TOKEN_PRESENT:
+            # Peers without the token are collected by its home.
+            return
+        home = min(list(self.peer_list.get_peers().keys()) + [self.owner.id])
+        if home != self.owner.id:
+            lock.give_token(home)
+            return
+        with lock.peer_list.lock:
+            if (entry.retired or lock.state != TOKEN_PRESENT or
+                    lock.waiting or lock.has_requests()):
+                return
+            # We hold the token and do not want it, so all our own
+            # requests have been served.
+            lock.token[self.owner.id] = lock.time
+            _, token = lock.token_status()
+            answers, failed = self.peer_list.broadcast("lock_forget", key,
+                                                       token)
+            if failed or not all(answers.values()):
+                return
+            with self.lock:
+                if entry.users == 0:
+                    self._retire(key, entry)
+
+    # Public methods
+
+    def initialize(self):
+        """Start collecting unused locks. peer_list must be populated."""
+        self.collector.start()
+
+    def destroy(self):
+        """Stop collecting and give away the tokens we have."""
+        self.stopped.set()
+        with self.lock:
+            entries = list(self.locks.values())
+        for entry in entries:
+            entry.lock.destroy()
+
+    def register_peer(self, pid):
+        """Called when a new peer joins the system."""
+        with self.lock:
+            entries = list(self.locks.values())
+        for entry in entries:
+            entry.lock.register_peer(pid)
+
+    def unregister_peer(self, pid):
+        """Called when a peer leaves the system."""
+        with self.lock:
+            entries = list(self.locks.values())
+        for entry in entries:
+            entry.lock.unregister_peer(pid)
+
+    def get_lock(self, key):
+        """Return a handle on the lock of key."""
+        return NamedLock(self, key)
+
+    def acquire(self, key, timeout=None):
+        """Acquire the lock of key.
+
+        Returns True if the lock was acquired, False on timeout.
+
+        """
+        with self.lock:
+            entry = self._entry(key)
+            entry.users += 1
+        acquired = False
+        try:
+            acquired = entry.lock.acquire(timeout)
+            return acquired
+        finally:
+            if not acquired:
+                with self.lock:
+                    entry.users -= 1
+
+    def release(self, key):
+        """Release the lock of key."""
+        with self.lock:
+            entry = self.locks[key]
+        entry.lock.release()
+        with self.lock:
+            entry.users -= 1
+            entry.used = time.monotonic()
+
+    def has_requests(self, key):
+        """Return True if another peer is waiting for the token of key."""
+        with self.lock:
+            entry = self.locks.get(key)
+        return entry is not None and entry.lock.has_requests()
+
+    def is_held(self, key):
+        """Return True if this peer currently holds the lock of key."""
+        with self.lock:
+            entry = self.locks.get(key)
+        return entry is not None and entry.lock.is_held()
+
+    def remote_calls(self):
+        """Return the methods the owner must make callable by peers."""
+        return {
+            "lock_request_token":     self.lock_request_token,
+            "lock_obtain_token":      self.lock_obtain_token,
+            "lock_token_status":      self.lock_token_status,
+            "lock_regenerate_token":  self.lock_regenerate_token,
+            "lock_forget":            self.lock_forget,
+        }
+
+    def lock_request_token(self, key, time, pid):
+        """Some other peer requests the token of key from us."""
+        return self._remote(key, "request_token", time, pid)
+
+    def lock_obtain_token(self, key, token):
+        """Some other peer gives us the token of key."""
+        return self._remote(key, "obtain_token", token)
+
+    def lock_token_status(self, key):
+        """Return our state and the latest token of key we have seen."""
+        return self._remote(key, "token_status")
+
+    def lock_regenerate_token(self, key, tokens):
+        """Rebuild the lost token of key."""
+        return self._remote(key, "regenerate_token", tokens)
+
+    def lock_forget(self, key, token):
+        """The home of the token of key asks us to forget its lock.
+
+        token is the current token. Returns True if the lock is
+        forgotten. We never wait for the state lock of key here: if it
+        is taken, the lock is in use anyway.
+
+        """
+        token = dict(token)
+        with self.lock:
+            entry = self.locks.get(key)
+            if entry is None:
+                return True
+            if entry.users > 0:
+                return False
+            lock = entry.lock
+            if not lock.peer_list.lock.acquire(blocking=False):
+                return False
+            try:
+                if lock.state != NO_TOKEN or lock.waiting:
+                    return False
+                if any(token.get(pid, 0) < t
+                       for pid, t in lock.request.items()
+                       if pid != self.owner.id):
+                    return False
+                self._retire(key, entry)
+                return True
+            finally:
+                lock.peer_list.lock.release()
+
+    def display_status(self):
+        """Print the status of the locks of this peer."""
+        with self.lock:
+            entries = sorted(self.locks.items())
+        print("Locks   :: {0}".format(len(entries)))
+        for key, entry in entries:
+            print("Lock '{0}' (users: {1})".format(key, entry.users))
+            entry.lock.display_status()
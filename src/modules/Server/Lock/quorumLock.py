@@ -0,0 +1,379 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Module for a quorum based distributed mutual exclusion.
+
+This implementation is based on Maekawa's algorithm. Instead of asking
+every peer for the token, a peer asks only the members of its quorum
+for their vote and enters the critical section once all of them have
+voted for it. Quorums are built on a grid: the peers, sorted by id, are
+laid out row by row in a square grid, and the quorum of a peer is its
+row and its column. Any two quorums intersect and each one has about
+2 * sqrt(N) members, so a critical section costs O(sqrt(N)) messages.
+
+Requests are ordered by (Lamport time, peer id). Deadlocks are avoided
+with the INQUIRE / RELINQUISH / FAILED messages:
+    --  a voter that receives a request older than the one it voted
+        for asks (INQUIRE) the peer it voted for to give the vote back;
+        a newer request is told that it has to wait (FAILED).
+    --  a peer that has been told to wait gives back (RELINQUISH) the
+        votes that are asked back from it, so the oldest request in the
+        system always gets all its votes.
+
+Messages are sent asynchronously, one at a time and in order, by a
+sender thread, so no remote call is ever made while the state lock is
+held. The quorums are computed from the current peer list, so the
+membership is assumed not to change while a peer is in the critical
+section.
+
+"""
+
+import math
+import heapq
+import queue
+import threading
+import time
+
+from ..peerList import COMMUNICATION_ERRORS
+
+RELEASED = 0
+WANTED = 1
+HELD = 2
+
+
+class QuorumLock(object):
+
+    """Quorum based distributed mutual exclusion for a list of peers.
+
+    Public methods:
+        --  __init__(owner, peer_list)
+        --  initialize()
+        --  destroy()
+        --  register_peer(pid)
+        --  unregister_peer(pid)
+        --  acquire(timeout=None)
+        --  release()
+        --  has_requests()
+        --  is_held()
+        --  remote_calls()
+        --  display_status()
+
+    and the remote methods quorum_request, quorum_grant, quorum_failed,
+    quorum_inquire, quorum_relinquish and quorum_release.
+
+    """
+
+    def __init__(self, owner, peer_list):
+        self.peer_list = peer_list
+        self.owner = owner
+        self.lock = threading.Condition()
+        self.time = 0
+        # Requester side.
+        self.state = RELEASED
+        self.request = None
+        self.asked = set()
+        self.grants = set()
+        self.failed = False
+        self.inquiries = set()
+        # Voter side.
+        self.voted_for = None
+        self.inquired = False
+        self.queue = []
+        # Outgoing messages.
+        self.outbox = queue.Queue()
+        self.sender = threading.Thread(target=self._send_loop)
+        self.sender.daemon = True
+        self.messages = 0
+
+    # Private methods
+
+    def _quorum(self):
+        """Return the ids of the peers in our quorum, ourselves included."""
+        members = sorted(list(self.peer_list.get_peers().keys()) +
+                         [self.owner.id])
+        k = int(math.ceil(math.sqrt(len(members))))
+        i = members.index(self.owner.id)
+        return set(m for j, m in enumerate(members)
+                   if j // k == i // k or j % k == i % k)
+
+    def _send(self, pid, method, *args):
+        """Queue a message; must be called with self.lock held."""
+        self.outbox.put((pid, method, args))
+
+    def _send_loop(self):
+        while True:
+            pid, method, args = self.outbox.get()
+            if pid is None:
+                return
+            self.messages += 1
+            try:
+                if pid == self.owner.id:
+                    getattr(self, method)(*args)
+                else:
+                    getattr(self.peer_list.peer(pid), method)(*args)
+            except KeyError:
+                # The peer has left meanwhile.
+                pass
+            except COMMUNICATION_ERRORS:
+                self.peer_list.drop(pid)
+
+    def _vote(self, request):
+        """Give our vote to request; must be called with self.lock held."""
+        self.voted_for = request
+        self.inquired = False
+        self._send(request[1], "quorum_grant", self.owner.id, request[0])
+
+    def _vote_next(self):
+        """Vote for the oldest queued request, if any."""
+        self.voted_for = None
+        self.inquired = False
+        if self.queue:
+            self._vote(tuple(heapq.heappop(self.queue)))
+
+    def _ask_quorum(self):
+        """Send our request to the quorum members not asked yet."""
+        for pid in self._quorum() - self.asked:
+            self.asked.add(pid)
+            self._send(pid, "quorum_request", self.request[0], self.owner.id)
+
+    def _check_grants(self):
+        """Enter the critical section once the whole quorum voted for us."""
+        if self.state == WANTED and self._quorum() <= self.grants:
+            self.state = HELD
+            self.inquiries.clear()
+            self.lock.notify_all()
+
+    def _relinquish(self, pid):
+        """Give a vote back to the voter that asked for it."""
+        self.grants.discard(pid)
+        self.inquiries.discard(pid)
+        self._send(pid, "quorum_relinquish", self.owner.id, self.request[0])
+
+    def _withdraw(self):
+        """Return all votes and cancel our request at every voter."""
+        for pid in self.asked:
+            self._send(pid, "quorum_release", self.owner.id)
+        self.state = RELEASED
+        self.request = None
+        self.asked = set()
+        self.grants = set()
+        self.failed = False
+        self.inquiries = set()
+
+    # Public methods
+
+    def initialize(self):
+        """Start the sender thread. peer_list must be populated."""
+        self.sender.start()
+
+    def destroy(self):
+        """Release the lock and stop sending messages."""
+        self.lock.acquire()
+        try:
+            if self.state != RELEASED:
+                self._withdraw()
+        finally:
+            self.lock.release()
+        self.outbox.put((None, None, None))
+        self.sender.join(5)
+
+    def register_peer(self, pid):
+        """Called when a new peer joins the system."""
+        self.lock.acquire()
+        try:
+            if self.state == WANTED:
+                # Our quorum may have changed.
+                self._ask_quorum()
+        finally:
+            self.lock.release()
+
+    def unregister_peer(self, pid):
+        """Called when a peer leaves the system."""
+        self.lock.acquire()
+        try:
+            self.queue = [r for r in self.queue if r[1] != pid]
+            heapq.heapify(self.queue)
+            if self.voted_for is not None and self.voted_for[1] == pid:
+                self._vote_next()
+            self.asked.discard(pid)
+            self.grants.discard(pid)
+            self.inquiries.discard(pid)
+            if self.state == WANTED:
+                # Our quorum has changed.
+                self._ask_quorum()
+                self._check_grants()
+        finally:
+            self.lock.release()
+
+    def acquire(self, timeout=None):
+        """Ask our quorum for its votes and wait for all of them.
+
+        Returns True if the lock was acquired, False on timeout.
+
+        """
+        print("Trying to acquire the lock...")
+        self.lock.acquire()
+        try:
+            self.time += 1
+            self.state = WANTED
+            self.request = (self.time, self.owner.id)
+            self._ask_quorum()
+            if timeout is not None:
+                deadline = time.monotonic() + timeout
+            while self.state != HELD:
+                if timeout is None:
+                    self.lock.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        print("Gave up waiting for the votes")
+                        self._withdraw()
+                        return False
+                    self.lock.wait(remaining)
+            print("Got all the votes")
+            return True
+        finally:
+            self.lock.release()
+
+    def release(self):
+        """Leave the critical section and return the votes."""
+        print("Releasing the lock...")
+        self.lock.acquire()
+        try:
+            if self.state == HELD:
+                self._withdraw()
+        finally:
+            self.lock.release()
+
+    def has_requests(self):
+        """Return True if another peer is waiting for our votes."""
+        self.lock.acquire()
+        try:
+            return bool(self.queue) or bool(self.inquiries)
+        finally:
+            self.lock.release()
+
+    def is_held(self):
+        """Return True if this peer currently holds the lock."""
+        return self.state == HELD
+
+    def remote_calls(self):
+        """Return the methods the owner must make callable by peers."""
+        return {
+            "quorum_request":     self.quorum_request,
+            "quorum_grant":       self.quorum_grant,
+            "quorum_failed":      self.quorum_failed,
+            "quorum_inquire":     self.quorum_inquire,
+            "quorum_relinquish":  self.quorum_relinquish,
+            "quorum_release":     self.quorum_release,
+        }
+
+    def quorum_request(self, time, pid):
+        """A peer of whose quorum we are a member asks for our vote."""
+        self.lock.acquire()
+        try:
+            self.time = max(self.time, time)
+            request = (time, pid)
+            if self.voted_for is None:
+                self._vote(request)
+                return
+            heapq.heappush(self.queue, request)
+            if request < self.voted_for and request == self.queue[0]:
+                # An older request: ask our vote back for it.
+                if not self.inquired:
+                    self.inquired = True
+                    self._send(self.voted_for[1], "quorum_inquire",
+                               self.owner.id, self.voted_for[0])
+            else:
+                self._send(pid, "quorum_failed", self.owner.id, time)
+        finally:
+            self.lock.release()
+
+    def _current(self, time):
+        """Tell whether a message is about our current request.
+
+        Messages about a request we have withdrawn are ignored: the
+        voter has received (or will receive before anything else from
+        us) the release of that request.
+
+        """
+        return self.state == WANTED and self.request[0] == time
+
+    def quorum_grant(self, pid, time):
+        """A voter gives us its vote."""
+        self.lock.acquire()
+        try:
+            if not self._current(time):
+                return
+            self.grants.add(pid)
+            if pid in self.inquiries and self.failed:
+                self._relinquish(pid)
+            self._check_grants()
+        finally:
+            self.lock.release()
+
+    def quorum_failed(self, pid, time):
+        """A voter tells us that an older request has its vote."""
+        self.lock.acquire()
+        try:
+            if not self._current(time):
+                return
+            self.failed = True
+            for voter in list(self.inquiries & self.grants):
+                self._relinquish(voter)
+        finally:
+            self.lock.release()
+
+    def quorum_inquire(self, pid, time):
+        """A voter asks its vote back for an older request."""
+        self.lock.acquire()
+        try:
+            if not self._current(time):
+                # We are in the critical section, so the vote comes
+                # back with our release, or the request is withdrawn.
+                return
+            self.inquiries.add(pid)
+            if self.failed and pid in self.grants:
+                self._relinquish(pid)
+        finally:
+            self.lock.release()
+
+    def quorum_relinquish(self, pid, time):
+        """The peer we voted for gives our vote back."""
+        self.lock.acquire()
+        try:
+            if self.voted_for != (time, pid):
+                return
+            heapq.heappush(self.queue, self.voted_for)
+            self._vote_next()
+        finally:
+            self.lock.release()
+
+    def quorum_release(self, pid):
+        """A peer leaves the critical section or withdraws its request."""
+        self.lock.acquire()
+        try:
+            self.queue = [r for r in self.queue if r[1] != pid]
+            heapq.heapify(self.queue)
+            if self.voted_for is not None and self.voted_for[1] == pid:
+                self._vote_next()
+        finally:
+            self.lock.release()
+
+    def display_status(self):
+        """Print the status of this peer."""
+        self.lock.acquire()
+        try:
+            print("State   :: released      : {0}".format(
+                self.state == RELEASED))
+            print("           wanted        : {0}".format(
+                self.state == WANTED))
+            print("           held          : {0}".format(self.state == HELD))
+            print("Quorum  :: {0}".format(sorted(self._quorum())))
+            print("Votes   :: {0}".format(sorted(self.grants)))
+            print("Voted   :: {0}".format(self.voted_for))
+            print("Queue   :: {0}".format(sorted(self.queue)))
+            print("Time    :: {0}".format(self.time))
+        finally:
+            self.lock.release()
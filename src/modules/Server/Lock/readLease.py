@@ -0,0 +1,104 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Class implementing time-bounded read leases."""
+
+import time
+import threading
+
+
+class ReadLease(object):
+
+    """Permission for a replica to serve consistent reads locally.
+
+    While the lease is valid, no write is in progress anywhere and the
+    local copy is up to date, so reads need no network round-trip.
+
+    Rules:
+        --  a writer revokes the lease of every replica before it
+            commits, and grants it again once the write is applied
+            everywhere. revoke() waits for the readers holding the
+            lease, so no read overlaps with a write.
+        --  the lease is only valid for lease_time seconds after it was
+            last granted or renewed. A writer that cannot reach a
+            replica waits lease_time seconds before committing, after
+            which the lease of that replica has expired.
+        --  an expired lease is renewed by its owner while it holds the
+            distributed write lock, i.e., while no write is in progress.
+
+    Revocations are counted per writer, so that concurrent writers (on
+    different shards) each have to grant the lease back.
+
+    """
+
+    def __init__(self, lease_time):
+        self.lease_time = lease_time
+        self.cond = threading.Condition(threading.Lock())
+        self.expires = 0
+        self.revocations = {}
+        self.readers = 0
+
+    # Public methods
+
+    def try_acquire(self):
+        """Start a read under the lease. Returns False if it is not valid."""
+        with self.cond:
+            if self.revocations or time.monotonic() >= self.expires:
+                return False
+            self.readers += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def wait(self):
+        """Wait until no write is in progress.
+
+        Returns True if the lease is then valid, False if it has expired
+        and has to be renewed.
+
+        """
+        with self.cond:
+            while self.revocations:
+                self.cond.wait()
+            return time.monotonic() < self.expires
+
+    def revoke(self, pid):
+        """Writer pid starts a write: wait for the readers to finish."""
+        with self.cond:
+            self.revocations[pid] = self.revocations.get(pid, 0) + 1
+            while self.readers > 0:
+                self.cond.wait()
+
+    def grant(self, pid):
+        """Writer pid has applied its write everywhere."""
+        with self.cond:
+            if pid in self.revocations:
+                self.revocations[pid] -= 1
+                if self.revocations[pid] == 0:
+                    del self.revocations[pid]
+            if not self.revocations:
+                self.expires = time.monotonic() + self.lease_time
+                self.cond.notify_all()
+
+    def renew(self):
+        """Renew the lease. The caller holds every distributed write lock.
+
+        No write can then be in progress, so revocations still pending
+        belong to writers that have died before granting the lease back.
+
+        """
+        with self.cond:
+            self.revocations = {}
+            self.expires = time.monotonic() + self.lease_time
+            self.cond.notify_all()
+
+    def forget(self, pid):
+        """Drop the revocations of a writer that has left the system."""
+        with self.cond:
+            if self.revocations.pop(pid, None) is not None:
+                self.cond.notify_all()
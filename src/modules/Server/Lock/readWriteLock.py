@@ -7,10 +7,16 @@
 # Copyright 2012 Linkoping University
 # -----------------------------------------------------------------------------
 
-"""Class implementing a readers-writers lock."""
+"""Classes implementing readers-writers locks."""
 
+import os
+import itertools
 import threading
 
+READER_PREFERRING = 0
+WRITER_PREFERRING = 1
+FIFO = 2
+
 
 class ReadWriteLock(object):
 
@@ -25,31 +31,224 @@ class ReadWriteLock(object):
             reading the resource,
         --  only one writer is allowed to modify the resource and all
             other existing readers and writers are blocked.
+
+    The order in which waiting threads get the lock depends on policy:
+        --  READER_PREFERRING: readers enter whenever no writer holds
+            the lock, so a stream of readers can starve the writers,
+        --  WRITER_PREFERRING: new readers wait as long as a writer is
+            waiting, so writers can not be starved (default),
+        --  FIFO: threads enter in arrival order, consecutive readers
+            entering together, so nobody is starved.
+
+    The lock is not owned by a thread: it may be released by another
+    thread than the one that acquired it.
     """
 
-    def __init__(self):
+    def __init__(self, policy=WRITER_PREFERRING):
+        if policy not in (READER_PREFERRING, WRITER_PREFERRING, FIFO):
+            raise ValueError("Unknown lock policy: {}".format(policy))
+        self.policy = policy
         self.reader_count = 0
-        self.reader_lock = threading.Lock()
-        self.writer_lock = threading.Lock()
+        self.writer_active = False
+        self.writers_waiting = 0
+        # Tickets used by the FIFO policy.
+        self.next_ticket = 0
+        self.serving = 0
+        self.cond = threading.Condition(threading.Lock())
+
+    # Private methods
+
+    def _take_ticket(self):
+        ticket = self.next_ticket
+        self.next_ticket += 1
+        return ticket
+
+    # Public methods
+
+    def read_acquire(self):
+        with self.cond:
+            if self.policy == FIFO:
+                ticket = self._take_ticket()
+                while ticket != self.serving or self.writer_active:
+                    self.cond.wait()
+                self.serving += 1
+                # The next in line may be a reader that can join us.
+                self.cond.notify_all()
+            elif self.policy == WRITER_PREFERRING:
+                while self.writer_active or self.writers_waiting > 0:
+                    self.cond.wait()
+            else:
+                while self.writer_active:
+                    self.cond.wait()
+            self.reader_count = self.reader_count + 1
+
+    def read_release(self):
+        with self.cond:
+            self.reader_count = self.reader_count - 1
+            if self.reader_count == 0:
+                self.cond.notify_all()
+
+    def write_acquire(self):
+        with self.cond:
+            if self.policy == FIFO:
+                ticket = self._take_ticket()
+                while (ticket != self.serving or self.writer_active or
+                        self.reader_count > 0):
+                    self.cond.wait()
+                self.serving += 1
+            else:
+                self.writers_waiting += 1
+                try:
+                    while self.writer_active or self.reader_count > 0:
+                        self.cond.wait()
+                finally:
+                    self.writers_waiting -= 1
+            self.writer_active = True
+
+    def write_release(self):
+        with self.cond:
+            self.writer_active = False
+            self.cond.notify_all()
+
+
+class _Stripe(object):
+
+    """Reader counter of a StripedReadWriteLock with its own mutex."""
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.count = 0
+
+
+class StripedReadWriteLock(object):
+
+    """Reader-Writer lock with scalable readers.
+
+    Follows the rules and policies of ReadWriteLock, but the readers are
+    counted on several stripes, each with its own mutex. Every thread
+    always uses the same stripe, so readers on different stripes never
+    wait for each other. Writers wait for each other on a central
+    condition, then drain the readers of every stripe.
+
+    With the READER_PREFERRING and WRITER_PREFERRING policies, readers
+    only take the mutex of their stripe. With FIFO, they also take a
+    ticket on the central condition, so they scale no better than with
+    ReadWriteLock.
+
+    Unlike ReadWriteLock, the read lock is counted on the stripe of the
+    thread, so it must be released by the thread that acquired it. The
+    write lock may be released by another thread.
+    """
+
+    def __init__(self, stripes=None, policy=WRITER_PREFERRING):
+        if policy not in (READER_PREFERRING, WRITER_PREFERRING, FIFO):
+            raise ValueError("Unknown lock policy: {}".format(policy))
+        if stripes is None:
+            stripes = os.cpu_count() or 1
+        self.policy = policy
+        self.stripes = [_Stripe() for _ in range(stripes)]
+        self.next_stripe = itertools.count()
+        self.local = threading.local()
+        self.cond = threading.Condition(threading.Lock())
+        self.writer_active = False
+        self.writers_waiting = 0
+        # Whether new readers must wait, read by the readers under the
+        # mutex of their stripe.
+        self.readers_blocked = False
+        # Tickets used by the FIFO policy.
+        self.next_ticket = 0
+        self.serving = 0
+
+    # Private methods
+
+    def _stripe(self):
+        """Return the stripe of the calling thread."""
+        try:
+            return self.local.stripe
+        except AttributeError:
+            n = next(self.next_stripe) % len(self.stripes)
+            self.local.stripe = self.stripes[n]
+            return self.local.stripe
+
+    def _drain(self):
+        """Wait until no reader holds the lock and block new readers."""
+        if self.policy != READER_PREFERRING:
+            # New readers are blocked already: wait for the others.
+            for stripe in self.stripes:
+                with stripe.cond:
+                    while stripe.count > 0:
+                        stripe.cond.wait()
+            return
+        # New readers keep entering until every stripe is empty at once.
+        while True:
+            for stripe in self.stripes:
+                stripe.cond.acquire()
+            busy = [stripe for stripe in self.stripes if stripe.count > 0]
+            if not busy:
+                self.readers_blocked = True
+            for stripe in reversed(self.stripes):
+                stripe.cond.release()
+            if not busy:
+                return
+            with busy[0].cond:
+                while busy[0].count > 0:
+                    busy[0].cond.wait()
 
     # Public methods
 
     def read_acquire(self):
-        self.reader_lock.acquire()
-        if self.reader_count == 0:
-            self.writer_lock.acquire()
-        self.reader_count = self.reader_count + 1
-        self.reader_lock.release()
+        stripe = self._stripe()
+        if self.policy == FIFO:
+            with self.cond:
+                ticket = self.next_ticket
+                self.next_ticket += 1
+                while ticket != self.serving or self.writer_active:
+                    self.cond.wait()
+                self.serving += 1
+                # Counted before the next in line, maybe a writer, enters.
+                with stripe.cond:
+                    stripe.count = stripe.count + 1
+                self.cond.notify_all()
+            return
+        with stripe.cond:
+            while self.readers_blocked:
+                stripe.cond.wait()
+            stripe.count = stripe.count + 1
 
     def read_release(self):
-        self.reader_lock.acquire()
-        self.reader_count = self.reader_count - 1
-        if self.reader_count == 0:
-            self.writer_lock.release()
-        self.reader_lock.release()
+        stripe = self._stripe()
+        with stripe.cond:
+            stripe.count = stripe.count - 1
+            if stripe.count == 0 and self.writer_active:
+                stripe.cond.notify_all()
 
     def write_acquire(self):
-        self.writer_lock.acquire()
+        with self.cond:
+            if self.policy == FIFO:
+                ticket = self.next_ticket
+                self.next_ticket += 1
+                while ticket != self.serving or self.writer_active:
+                    self.cond.wait()
+                self.serving += 1
+            else:
+                self.writers_waiting += 1
+                if self.policy == WRITER_PREFERRING:
+                    self.readers_blocked = True
+                try:
+                    while self.writer_active:
+                        self.cond.wait()
+                finally:
+                    self.writers_waiting -= 1
+            self.writer_active = True
+        self._drain()
 
     def write_release(self):
-        self.writer_lock.release()
+        with self.cond:
+            self.writer_active = False
+            # Writers still waiting keep the readers out.
+            self.readers_blocked = (self.policy == WRITER_PREFERRING and
+                                    self.writers_waiting > 0)
+            self.cond.notify_all()
+        for stripe in self.stripes:
+            with stripe.cond:
+                stripe.cond.notify_all()
@@ -0,0 +1,154 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Module for passing the writes down a chain of servers."""
+
+import threading
+
+from . import replicator
+from .primaryMode import PrimaryMode
+
+
+class ChainMode(PrimaryMode):
+
+    """The writes flow from the head of the chain down to its tail.
+
+    The chain is made of the servers alive in the order of their ids.
+    The head, which is the primary, commits the writes and passes them
+    on to its successor, and so on. The tail acknowledges them to the
+    head and serves all the reads, so that a read sees every write that
+    has returned. A joining server is the tail as soon as it registers,
+    so that the writes flow to it, but it serves the reads only once it
+    has caught up with the others.
+
+    Public methods:
+        --  __init__(server)
+        --  start()
+        --  remote_calls()
+        --  replicate(seq, fortunes)
+        --  commit(fortunes)
+        --  forward_read(method, *args)
+        --  read_version(version=None, r=None)
+        --  peer_left(pid)
+        --  chain_write(origin, seq, fortunes)
+        --  chain_ack(origin, seq)
+        --  display_status()
+
+    """
+
+    def __init__(self, server):
+        PrimaryMode.__init__(self, server)
+        # Highest of our writes acknowledged by the tail of the chain.
+        self.acked = 0
+        self.cond = threading.Condition()
+
+    # Private methods
+
+    def _tail(self):
+        return self._chain()[-1]
+
+    def _successor(self):
+        """Return the id of the next server in the chain, or None."""
+        chain = self._chain()
+        position = chain.index(self.server.id)
+        if position + 1 < len(chain):
+            return chain[position + 1]
+        return None
+
+    def _ack(self):
+        """If we are the tail, acknowledge the writes we have applied."""
+        if self._successor() is not None:
+            return
+        head = self._primary()
+        for origin, seq in self.server.log.vector():
+            if origin == head == self.server.id:
+                self.chain_ack(origin, seq)
+            elif origin == head:
+                self.server.replicator.replicate(
+                    "chain_ack", origin, seq, pids=[head],
+                    ack=replicator.LOCAL)
+
+    def _wait_ack(self, seq):
+        """Wait until the tail has applied our write seq."""
+        with self.cond:
+            while self.acked < seq and self._successor() is not None:
+                # Check the chain again now and then: a new tail acks
+                # once it has caught up.
+                self.cond.wait(1.0)
+
+    def _sync(self):
+        PrimaryMode._sync(self)
+        self._ack()
+
+    # Public methods
+
+    def start(self):
+        self._ack()
+
+    def remote_calls(self):
+        calls = PrimaryMode.remote_calls(self)
+        calls.update({
+            "chain_write":        self.chain_write,
+            "chain_ack":          self.chain_ack,
+        })
+        return calls
+
+    def replicate(self, seq, fortunes):
+        """Pass our write on down the chain without waiting."""
+        successor = self._successor()
+        if successor is not None:
+            self.server.replicator.replicate(
+                "chain_write", self.server.id, seq, fortunes,
+                pids=[successor], ack=replicator.LOCAL)
+
+    def commit(self, fortunes):
+        """Commit fortunes and wait until the tail has applied them."""
+        seqs = PrimaryMode.commit(self, fortunes)
+        if seqs:
+            self._wait_ack(max(seqs.values()))
+        return seqs
+
+    def forward_read(self, method, *args):
+        """Send the read to the tail unless we are it."""
+        return self._forward(self._tail, method, *args, read=True)
+
+    def read_version(self, version=None, r=None):
+        """Wait until we have caught up, then return version.
+
+        Only the tail serves reads, and a joining tail may still miss
+        writes that have returned.
+
+        """
+        self.server.synced.wait()
+        return version
+
+    def peer_left(self, pid):
+        # Whichever server has left, its neighbours have changed.
+        self._resync()
+
+    def chain_write(self, origin, seq, fortunes):
+        """Apply a write coming down the chain and pass it on.
+
+        The tail acknowledges the write to the head, origin, instead.
+
+        """
+        self.server._apply(self.server.log.accept(origin, seq, fortunes))
+        successor = self._successor()
+        if successor is not None:
+            self.server.replicator.replicate(
+                "chain_write", origin, seq, fortunes, pids=[successor],
+                ack=replicator.LOCAL)
+        else:
+            self._ack()
+
+    def chain_ack(self, origin, seq):
+        """The tail has applied our writes up to seq."""
+        with self.cond:
+            if origin == self.server.id and seq > self.acked:
+                self.acked = seq
+                self.cond.notify_all()
+
+    def display_status(self):
+        print("Chain :: {}".format(" -> ".join(
+            str(pid) for pid in self._chain())))
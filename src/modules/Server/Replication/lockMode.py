@@ -0,0 +1,46 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Module for ordering the writes with the distributed lock."""
+
+from ..Lock.distributedReadWriteLock import LockRevoked
+from .replicationMode import ReplicationMode
+
+
+class LockMode(ReplicationMode):
+
+    """Every server commits its writes under the distributed lock.
+
+    The lock holder applies and replicates everything queued so far, so
+    writes queued behind the token are committed together with ours.
+
+    Public methods:
+        --  write_acquire(shard)
+        --  write_release(shard)
+        --  can_commit(shard)
+
+    """
+
+    # Public methods
+
+    def write_acquire(self, shard):
+        self.server.drwlocks[shard].write_acquire()
+
+    def write_release(self, shard):
+        try:
+            self.server.drwlocks[shard].write_release()
+        except LockRevoked:
+            # Nothing was committed under this hold: the writers whose
+            # fortunes were queued have been told by can_commit().
+            pass
+
+    def can_commit(self, shard):
+        """Tell whether we still hold the distributed lock of a shard.
+
+        The lock may have been taken away meanwhile (max_hold). Once
+        this has returned True, the commit counts as done under the
+        lock, see DistributedReadWriteLock.begin_commit().
+
+        """
+        return self.server.drwlocks[shard].begin_commit()
@@ -0,0 +1,132 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Module for ordering the writes by a primary server."""
+
+import threading
+
+from ..peerList import COMMUNICATION_ERRORS
+from .replicationMode import ReplicationMode
+
+
+class PrimaryMode(ReplicationMode):
+
+    """The writes are forwarded to the primary, which orders them.
+
+    The primary is the server with the lowest id still alive. It commits
+    the writes under its local locks and sends them to the other servers.
+    A server that notices a failed replica drops it and tells the others,
+    and once the primary has failed a new one takes over: every server
+    then fetches the writes it has missed from all the others.
+
+    Public methods:
+        --  on_drop(pid)
+        --  remote_calls()
+        --  write(fortune, w=None)
+        --  write_many(fortunes, w=None)
+        --  peer_left(pid)
+        --  peer_failed(pid)
+        --  display_status()
+
+    """
+
+    # Private methods
+
+    def _chain(self):
+        """Return the ids of the servers alive, in the order of the chain."""
+        return sorted([self.server.id] +
+                      list(self.server.peer_list.get_peers().keys()))
+
+    def _primary(self):
+        """Return the id of the primary: the lowest id still alive."""
+        return self._chain()[0]
+
+    def _forward(self, choose, method, *args, read=False):
+        """Send a call to the server choose() returns, unless it is us.
+
+        Returns a pair (forwarded, result). A server that does not
+        respond is dropped and the call is sent to the next one. A write
+        is only sent again if the connection was refused, as in
+        ReplicaRouter: otherwise, the failed server may have applied it.
+
+        """
+        while True:
+            pid = choose()
+            if pid == self.server.id:
+                return False, None
+            try:
+                return True, getattr(self.server.peer_list.peer(pid),
+                                     method)(*args)
+            except KeyError:
+                # The server has just left, try the next one.
+                continue
+            except COMMUNICATION_ERRORS as e:
+                if not read and not isinstance(e, ConnectionRefusedError):
+                    raise
+                self.on_drop(pid)
+
+    def _resync(self):
+        sync = threading.Thread(target=self._sync)
+        sync.daemon = True
+        sync.start()
+
+    def _sync(self):
+        """Fetch the writes of a failed server that we have missed.
+
+        The primary, or a server of the chain, may have failed while
+        passing a write on, which then reached only some of the
+        servers. Every server fetches what it misses from all the
+        others.
+
+        """
+        peer_list = self.server.peer_list
+        for pid in sorted(peer_list.get_peers().keys()):
+            try:
+                self.server._catch_up_from(peer_list.peer(pid))
+            except (KeyError,) + COMMUNICATION_ERRORS:
+                pass
+
+    # Public methods
+
+    def on_drop(self, pid):
+        """Drop a failed server and tell the other servers about it."""
+        self.server.peer_list.drop(pid)
+        self.server.peer_list.broadcast("peer_failed", pid)
+
+    def remote_calls(self):
+        return {
+            "peer_failed":        self.peer_failed,
+        }
+
+    def write(self, fortune, w=None):
+        forwarded, version = self._forward(self._primary, "write", fortune)
+        if forwarded:
+            return version
+        return ReplicationMode.write(self, fortune, w)
+
+    def write_many(self, fortunes, w=None):
+        forwarded, count = self._forward(self._primary, "write_many",
+                                         fortunes)
+        if forwarded:
+            return count
+        return ReplicationMode.write_many(self, fortunes, w)
+
+    def peer_left(self, pid):
+        # The primary is the lowest id, so it was pid if pid is lower
+        # than the lowest id left.
+        if pid < self._primary():
+            print("Server {} is the new primary.".format(self._primary()))
+            self._resync()
+
+    def peer_failed(self, pid):
+        """Server pid has failed.
+
+        Called by the server that has noticed it.
+
+        """
+        if pid in self.server.peer_list.get_peers():
+            self.server.peer_list.drop(pid)
+
+    def display_status(self):
+        print("Primary :: server {}".format(self._primary()))
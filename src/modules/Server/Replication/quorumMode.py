@@ -0,0 +1,144 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Module for quorum reads and writes."""
+
+import random
+import threading
+
+from ..peerList import COMMUNICATION_ERRORS
+from .replicationLog import merge_versions
+from .replicationMode import ReplicationMode
+
+
+class QuorumMode(ReplicationMode):
+
+    """Every server commits its writes by itself, on W of the N servers.
+
+    A write returns once W servers, this one included, have applied it,
+    and a read first brings its version up to date with R servers. With
+    R + W greater than N, every read sees the writes that have returned.
+    R and W default to a majority of the servers alive.
+
+    Public methods:
+        --  __init__(server, read_quorum=None, write_quorum=None)
+        --  read_version(version=None, r=None)
+        --  write(fortune, w=None)
+        --  write_many(fortunes, w=None)
+        --  display_status()
+
+    """
+
+    def __init__(self, server, read_quorum=None, write_quorum=None):
+        ReplicationMode.__init__(self, server)
+        self.read_quorum = read_quorum
+        self.write_quorum = write_quorum
+        # Orders the writes made here, see _write().
+        self.commit_lock = threading.Lock()
+        self.rand = random.Random()
+        self.rand.seed()
+
+    # Private methods
+
+    def _quorum(self, size):
+        """Return a quorum of size servers, or a majority if size is None.
+
+        Raises an exception if fewer servers are alive.
+
+        """
+        alive = len(self.server.peer_list.get_peers()) + 1
+        if size is None:
+            return alive // 2 + 1
+        if size < 1:
+            raise ValueError("A quorum holds at least one server.")
+        if size > alive:
+            raise Exception("Only {} servers are alive, a quorum of {} is "
+                            "needed.".format(alive, size))
+        return size
+
+    def _write(self, fortunes, w=None):
+        """Apply fortunes here and return once w servers have applied them.
+
+        The write is committed under the local locks only: every server
+        numbers its own writes, which the others apply in order, and the
+        fortunes of different servers can be applied in any order. The
+        numbers are handed out and the updates queued under commit_lock,
+        so that the other servers receive them in order and apply them
+        as soon as they acknowledge them.
+
+        Returns the version token of the write.
+
+        """
+        server = self.server
+        w = self._quorum(w if w is not None else self.write_quorum)
+        version = []
+        sent = []
+        with self.commit_lock:
+            for shard, batch in sorted(server._split(fortunes).items()):
+                server.drwlocks[shard].write_acquire_local()
+                try:
+                    server.db.write_many(batch)
+                    # Numbered only once applied, see
+                    # Server._commit_pending().
+                    seq = server.log.next_seq(server.id)
+                    server.log.record(server.id, seq, batch)
+                finally:
+                    server.drwlocks[shard].write_release_local()
+                sent.append(server.replicator.submit(
+                    "write_many_local", batch, server.id, seq, ack=w - 1))
+                version = [[server.id, seq]]
+        for futures in sent:
+            acked = server.replicator.wait(futures, w - 1)
+            if acked < w - 1:
+                # The write stays applied here and reaches the other
+                # servers as they come back.
+                raise Exception("The write has only been applied by {} of "
+                                "the {} servers needed.".format(acked + 1, w))
+        return version
+
+    # Public methods
+
+    def read_version(self, version=None, r=None):
+        """Return the latest version known to a read quorum.
+
+        The vectors of r - 1 other servers, at random, are merged with
+        version. If some of them have applied writes we have not, these
+        are fetched from them first (read repair).
+
+        """
+        peer_list = self.server.peer_list
+        r = self._quorum(r if r is not None else self.read_quorum)
+        pids = list(peer_list.get_peers().keys())
+        self.rand.shuffle(pids)
+        vectors = {}
+        while len(vectors) < r - 1:
+            wanted = r - 1 - len(vectors)
+            if len(pids) < wanted:
+                raise Exception("Only {} of the {} servers needed have "
+                                "answered.".format(len(vectors) + 1, r))
+            asked, pids = pids[:wanted], pids[wanted:]
+            results, _ = peer_list.broadcast("log_vector", pids=asked)
+            vectors.update(results)
+        for pid, vector in sorted(vectors.items()):
+            local = dict(self.server.log.expected_vector())
+            if any(seq > local.get(origin, 0) for origin, seq in vector):
+                try:
+                    self.server._repair(peer_list.peer(pid))
+                except (KeyError,) + COMMUNICATION_ERRORS:
+                    # The read waits for these writes instead.
+                    pass
+            version = merge_versions(version, vector)
+        return version
+
+    def write(self, fortune, w=None):
+        return self._write([fortune], w)
+
+    def write_many(self, fortunes, w=None):
+        self._write(fortunes, w)
+        return len(fortunes)
+
+    def display_status(self):
+        print("Quorums :: N = {}, R = {}, W = {}".format(
+            len(self.server.peer_list.get_peers()) + 1,
+            self._quorum(self.read_quorum), self._quorum(self.write_quorum)))
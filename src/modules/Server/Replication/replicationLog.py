@@ -0,0 +1,302 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Ordered log of the writes applied by a replica.
+
+Every write is a batch of fortunes identified by the id of the server
+that made it (its origin) and a sequence number, counted per origin. A
+replica applies the writes of each origin in sequence order: writes
+received out of order wait for the missing ones and writes received
+twice are ignored. What a replica has applied is then described by a
+vector giving, for each origin, the last sequence number applied.
+
+A replica that has missed writes sends its vector to another replica,
+which answers with the entries of its log after that vector. If the log
+does not go back far enough, i.e., the writes are only in the data of
+the replica (its base), a snapshot of the data is needed instead.
+
+The log is kept on disk as a journal next to the data file: an optional
+first line with the base vector, followed by one line per entry. Once
+a snapshot of the data has been taken, the entries it contains can be
+dropped (see compact()), so the journal does not grow without bound.
+
+Vectors also serve clients as version tokens: a client keeps the vector
+of its own writes and a replica serves its reads once it has applied
+that vector (see wait_for()).
+
+"""
+
+import os
+import json
+import time
+import threading
+
+
+class StaleReplica(Exception):
+
+    """The replica has not applied the version a client asked for.
+
+    The arguments are a message and the id of the server that made the
+    missing write, which the client can read from instead.
+
+    """
+
+    pass
+
+
+def merge_versions(version, other):
+    """Return the vector covering both vectors, as [origin, seq] pairs."""
+
+    merged = dict(version or [])
+    for origin, seq in other or []:
+        merged[origin] = max(merged.get(origin, 0), seq)
+    return sorted([o, s] for o, s in merged.items())
+
+
+class ReplicationLog(object):
+
+    """Log of the writes applied by one replica.
+
+    Public methods:
+        --  __init__(log_file)
+        --  next_seq(origin)
+        --  accept(origin, seq, fortunes)
+        --  record(origin, seq, fortunes)
+        --  vector()
+        --  expected_vector()
+        --  wait_for(vector, timeout)
+        --  since(vector, limit, max_gap=None)
+        --  extras()
+        --  install(base, extras)
+        --  compact(vector)
+
+    """
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.lock = threading.Condition(threading.Lock())
+        # Writes contained in the data, but not in the log.
+        self.base = {}
+        # The entries of the log: origin -> {seq: fortunes}.
+        self.entries = {}
+        # Last contiguous sequence number recorded, per origin.
+        self.applied = {}
+        # Last sequence number handed out for applying, per origin.
+        self.expected = {}
+        # Entries received ahead of a missing one, per origin.
+        self.pending = {}
+        self._load()
+
+    # Private methods
+
+    def _load(self):
+        if not os.path.exists(self.log_file):
+            return
+        with open(self.log_file, "r") as journal:
+            for line in journal:
+                record = json.loads(line)
+                if isinstance(record, dict):
+                    self.base = dict(record["base"])
+                else:
+                    origin, seq, fortunes = record
+                    self.entries.setdefault(origin, {})[seq] = fortunes
+        self.applied = dict(self.base)
+        for origin in self.entries:
+            self._advance(origin)
+        self.expected = dict(self.applied)
+
+    def _save(self):
+        """Rewrite the journal with the base and the current entries."""
+        tmp_file = self.log_file + ".tmp"
+        with open(tmp_file, "w") as journal:
+            journal.write(json.dumps({"base": sorted(self.base.items())}) +
+                          "\n")
+            for origin, entries in sorted(self.entries.items()):
+                for seq, fortunes in sorted(entries.items()):
+                    journal.write(json.dumps([origin, seq, fortunes]) + "\n")
+        os.replace(tmp_file, self.log_file)
+
+    def _advance(self, origin):
+        """Move applied[origin] over the contiguous recorded entries."""
+        seq = self.applied.get(origin, 0)
+        entries = self.entries.get(origin, {})
+        while seq + 1 in entries:
+            seq += 1
+        self.applied[origin] = seq
+
+    def _drain(self, origin):
+        """Return the pending entries of origin that are next in line."""
+        ready = []
+        waiting = self.pending.get(origin, {})
+        seq = self.expected.get(origin, 0) + 1
+        while seq in waiting:
+            fortunes = waiting.pop(seq)
+            if seq not in self.entries.get(origin, {}):
+                ready.append([origin, seq, fortunes])
+            self.expected[origin] = seq
+            seq += 1
+        return ready
+
+    # Public methods
+
+    def __len__(self):
+        """Return the number of entries in the log."""
+        with self.lock:
+            return sum(len(entries) for entries in self.entries.values())
+
+    def next_seq(self, origin):
+        """Return the sequence number of a new write made by origin."""
+        with self.lock:
+            seq = self.expected.get(origin, 0) + 1
+            self.expected[origin] = seq
+            return seq
+
+    def accept(self, origin, seq, fortunes):
+        """Take a write received from a replica.
+
+        Returns the entries that can now be applied, in order, as a list
+        of [origin, seq, fortunes]. Each of them must be recorded once
+        it is applied.
+
+        """
+        with self.lock:
+            if seq <= self.expected.get(origin, 0):
+                return []
+            self.pending.setdefault(origin, {})[seq] = fortunes
+            return self._drain(origin)
+
+    def record(self, origin, seq, fortunes):
+        """Record a write that has been applied to the data."""
+        with self.lock:
+            self.entries.setdefault(origin, {})[seq] = fortunes
+            with open(self.log_file, "a") as journal:
+                journal.write(json.dumps([origin, seq, fortunes]) + "\n")
+            self._advance(origin)
+            self.lock.notify_all()
+
+    def vector(self):
+        """Return the writes applied so far, as [origin, seq] pairs."""
+        with self.lock:
+            return sorted([o, s] for o, s in self.applied.items())
+
+    def expected_vector(self):
+        """Return the writes applied or being applied, as pairs."""
+        with self.lock:
+            return sorted([o, s] for o, s in self.expected.items())
+
+    def wait_for(self, vector, timeout):
+        """Wait up to timeout seconds until vector has been applied.
+
+        Returns None once it is, else an origin of a missing write.
+
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                missing = [origin for origin, seq in vector
+                           if self.applied.get(origin, 0) < seq]
+                if not missing:
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return missing[0]
+                self.lock.wait(remaining)
+
+    def since(self, vector, limit, max_gap=None):
+        """Return the entries a replica with the given vector misses.
+
+        At most limit entries are returned, as a pair [entries, more],
+        more telling whether there are entries left. None is returned
+        if some of the entries are not in the log anymore, or if more
+        than max_gap entries are missing.
+
+        """
+        vector = dict(vector)
+        with self.lock:
+            missing = 0
+            for origin, seq in self.applied.items():
+                have = vector.get(origin, 0)
+                if have < self.base.get(origin, 0):
+                    return None
+                missing += max(0, seq - have)
+            if max_gap is not None and missing > max_gap:
+                return None
+            result = []
+            for origin in sorted(self.applied):
+                first = vector.get(origin, 0) + 1
+                for seq in range(first, self.applied[origin] + 1):
+                    if len(result) >= limit:
+                        return [result, True]
+                    result.append([origin, seq, self.entries[origin][seq]])
+            return [result, False]
+
+    def extras(self):
+        """Return the entries recorded after a missing one."""
+        with self.lock:
+            return [[origin, seq, fortunes]
+                    for origin, entries in sorted(self.entries.items())
+                    for seq, fortunes in sorted(entries.items())
+                    if seq > self.applied.get(origin, 0)]
+
+    def install(self, base, extras):
+        """Start over from a snapshot of another replica.
+
+        base is the vector of the snapshot and extras the entries it
+        contains beyond base (see extras()). Returns the entries that
+        must be applied to the snapshot: the ones that were applied to
+        the old data but are not in the snapshot, and the pending ones
+        that are now next in line.
+
+        """
+        base = dict(base)
+        with self.lock:
+            ready = [[origin, seq, fortunes]
+                     for origin, entries in sorted(self.entries.items())
+                     for seq, fortunes in sorted(entries.items())
+                     if seq > base.get(origin, 0)]
+            self.base = base
+            self.entries = {}
+            for origin, seq, fortunes in extras:
+                self.entries.setdefault(origin, {})[seq] = fortunes
+            ready = [e for e in ready
+                     if e[1] not in self.entries.get(e[0], {})]
+            self.applied = dict(base)
+            for origin in self.entries:
+                self._advance(origin)
+            for origin, seq in base.items():
+                self.expected[origin] = max(self.expected.get(origin, 0), seq)
+            for origin in list(self.pending):
+                expected = self.expected.get(origin, 0)
+                self.pending[origin] = dict(
+                    (seq, fortunes)
+                    for seq, fortunes in self.pending[origin].items()
+                    if seq > expected)
+                ready.extend(self._drain(origin))
+            self._save()
+            self.lock.notify_all()
+            return ready
+
+    def compact(self, vector):
+        """Drop the entries up to vector from the log.
+
+        The data must contain these writes, e.g., vector is the vector
+        of a snapshot. Replicas that have not applied them need a
+        snapshot from then on. Returns the number of entries dropped.
+
+        """
+        with self.lock:
+            dropped = 0
+            moved = False
+            for origin, seq in vector:
+                if seq <= self.base.get(origin, 0):
+                    continue
+                self.base[origin] = seq
+                moved = True
+                entries = self.entries.get(origin, {})
+                for old in [s for s in entries if s <= seq]:
+                    del entries[old]
+                    dropped += 1
+            if moved:
+                self._save()
+            return dropped
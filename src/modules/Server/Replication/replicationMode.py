@@ -0,0 +1,117 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Module for the ways a server orders and replicates its writes.
+
+A lab5 server hands everything that depends on its replication mode to
+an object of one of the subclasses of ReplicationMode:
+    --  LockMode: every server commits its writes under the distributed
+        lock and sends them to all the replicas,
+    --  PrimaryMode: the writes are forwarded to the primary, the server
+        with the lowest id, which commits them under its local locks,
+    --  ChainMode: the writes flow from the primary (the head) through
+        the servers in the order of their ids, and the last one (the
+        tail) acknowledges them and serves all the reads,
+    --  QuorumMode: every server commits its writes by itself, a write
+        returns once W servers have applied it and a read first fetches
+        the latest version from R servers.
+
+"""
+
+
+class ReplicationMode(object):
+
+    """How a server orders and replicates its writes.
+
+    The writes made here are committed under the local locks of the
+    server and sent to all the replicas with 'write_many_local'.
+
+    Public methods:
+        --  __init__(server)
+        --  start()
+        --  remote_calls()
+        --  write_acquire(shard)
+        --  write_release(shard)
+        --  can_commit(shard)
+        --  replicate(seq, fortunes)
+        --  commit(fortunes)
+        --  forward_read(method, *args)
+        --  read_version(version=None, r=None)
+        --  write(fortune, w=None)
+        --  write_many(fortunes, w=None)
+        --  peer_left(pid)
+        --  display_status()
+
+    """
+
+    # Called by the replicator with a replica that does not respond, see
+    # Replicator. None lets the replicator only drop it, see PeerList.drop().
+    on_drop = None
+
+    def __init__(self, server):
+        self.server = server
+
+    # Public methods
+
+    def start(self):
+        """Called once the server has caught up with the others."""
+        pass
+
+    def remote_calls(self):
+        """Return the methods the server must make callable by peers."""
+        return {}
+
+    def write_acquire(self, shard):
+        """Take the write lock of a shard, for a write made here."""
+        self.server.drwlocks[shard].write_acquire_local()
+
+    def write_release(self, shard):
+        self.server.drwlocks[shard].write_release_local()
+
+    def can_commit(self, shard):
+        """Tell whether the writes of a shard may still be committed.
+
+        Called with the write lock of the shard held.
+
+        """
+        return True
+
+    def replicate(self, seq, fortunes):
+        """Send our write seq, just committed here, to the replicas."""
+        self.server.replicator.replicate("write_many_local", fortunes,
+                                         self.server.id, seq)
+
+    def commit(self, fortunes):
+        """Commit fortunes here, see Server._commit()."""
+        return self.server._commit(fortunes)
+
+    def forward_read(self, method, *args):
+        """Send a read to the server that must serve it, unless it is us.
+
+        Returns a pair (forwarded, result).
+
+        """
+        return False, None
+
+    def read_version(self, version=None, r=None):
+        """Return the version a read made here must see."""
+        return version
+
+    def write(self, fortune, w=None):
+        """Write a fortune and return the version token of the write."""
+        seqs = self.commit([fortune])
+        return [[self.server.id, max(seqs.values())]]
+
+    def write_many(self, fortunes, w=None):
+        """Write a list of fortunes and return how many were written."""
+        self.commit(fortunes)
+        return len(fortunes)
+
+    def peer_left(self, pid):
+        """Called once server pid has been removed from the peer list."""
+        pass
+
+    def display_status(self):
+        """Print the status of the mode."""
+        pass
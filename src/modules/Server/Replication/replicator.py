@@ -0,0 +1,349 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Module for sending updates to all the replicas of a server.
+
+Every replica has a queue of the updates it has not received yet, sent
+in order by a thread of its own. While a call to the replica is in
+flight, new updates wait in the queue and are then sent together, in a
+single 'replicate_batch' call of at most max_batch updates. The more
+updates are committed concurrently, the fewer calls per update.
+
+How many replicas must acknowledge an update before replicate() returns
+is set by the ack policy:
+    --  ALL: every replica has applied the update (or has failed),
+    --  MAJORITY: a majority of the replicas, this server included, has
+        applied it; the others catch up in the background,
+    --  LOCAL: only this server has applied it; all the replicas catch
+        up in the background. Nobody waits for the updates then, so
+        they are kept in the queue for up to batch_delay seconds to be
+        sent with the next ones,
+    --  a number n: n replicas, this server excluded, have applied it.
+
+A replica that cannot be reached is either dropped (DROP), by calling
+on_drop, by default PeerList.drop(), or keeps its queue (REPAIR). The
+queue is retried every repair_interval seconds, until the replica
+answers again or leaves the system; meanwhile new updates for it are
+queued behind the missed ones.
+
+"""
+
+import time
+import threading
+import concurrent.futures
+
+from ..peerList import COMMUNICATION_ERRORS
+
+ALL = "all"
+MAJORITY = "majority"
+LOCAL = "local"
+
+DROP = "drop"
+REPAIR = "repair"
+
+
+class NotApplied(Exception):
+
+    """A replica has received an update but has not applied it yet.
+
+    The update is not counted as acknowledged by wait(), nor is it
+    reported as an error: the replica applies it later on its own.
+
+    """
+
+    pass
+
+
+class _Queue(object):
+
+    """Updates waiting to be sent to one replica, in order.
+
+    Every update is a list [method, args, future, due], future being
+    None if nobody waits for it and due the time it must be sent at.
+
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.failing = False
+        self.retry_at = 0
+
+
+class Replicator(object):
+
+    """Sends the updates of a server to its replicas.
+
+    Public methods:
+        --  __init__(owner, peer_list, ack=ALL, failed=DROP,
+                     repair_interval=1.0, max_batch=64, batch_delay=0.0,
+                     on_drop=None)
+        --  destroy()
+        --  unregister_peer(pid)
+        --  replicate(method, *args, pids=None, ack=None)
+        --  submit(method, *args, pids=None, ack=None)
+        --  wait(futures, ack=None)
+        --  flush()
+        --  display_status()
+
+    """
+
+    def __init__(self, owner, peer_list, ack=ALL, failed=DROP,
+                 repair_interval=1.0, max_batch=64, batch_delay=0.0,
+                 on_drop=None):
+        if ack not in (ALL, MAJORITY, LOCAL):
+            raise ValueError("Unknown ack policy: '{}'".format(ack))
+        if failed not in (DROP, REPAIR):
+            raise ValueError("Unknown failure policy: '{}'".format(failed))
+        if max_batch < 1:
+            raise ValueError("A batch holds at least one update.")
+        self.owner = owner
+        self.peer_list = peer_list
+        self.ack = ack
+        self.failed = failed
+        self.repair_interval = repair_interval
+        self.max_batch = max_batch
+        self.batch_delay = batch_delay
+        self.on_drop = on_drop or peer_list.drop
+        self.cond = threading.Condition()
+        self.queues = {}
+        self.stopped = False
+
+    # Private methods
+
+    def _needed(self, sent, ack):
+        """Return how many of the sent updates must be acknowledged."""
+        if ack == LOCAL:
+            return 0
+        if isinstance(ack, int):
+            return min(sent, ack)
+        if ack == MAJORITY:
+            replicas = len(self.peer_list.get_peers()) + 1
+            return min(sent, replicas // 2)
+        return sent
+
+    def _queue(self, pid):
+        """Return the queue of replica pid, starting its sender if new.
+
+        Must be called with cond held.
+
+        """
+        queue = self.queues.get(pid)
+        if queue is None:
+            queue = self.queues[pid] = _Queue()
+            sender = threading.Thread(target=self._send_loop,
+                                      args=(pid, queue))
+            sender.daemon = True
+            sender.start()
+        return queue
+
+    def _fail(self, updates, error):
+        """Tell whoever waits for updates that they were not applied.
+
+        Must be called with cond held.
+
+        """
+        for update in updates:
+            if update[2] is not None:
+                update[2].set_exception(error)
+                update[2] = None
+
+    def _next_batch(self, pid, queue):
+        """Wait until a batch of updates is due. None means stop."""
+        with self.cond:
+            while not self.stopped and self.queues.get(pid) is queue:
+                batch = queue.updates[:self.max_batch]
+                if batch:
+                    if queue.failing:
+                        due = queue.retry_at
+                    elif len(batch) == self.max_batch:
+                        due = 0
+                    else:
+                        due = min(update[3] for update in batch)
+                    now = time.monotonic()
+                    if now >= due:
+                        return batch
+                    self.cond.wait(due - now)
+                else:
+                    self.cond.wait()
+            return None
+
+    def _send_loop(self, pid, queue):
+        while True:
+            batch = self._next_batch(pid, queue)
+            if batch is None:
+                return
+            try:
+                stub = self.peer_list.peer(pid)
+            except KeyError:
+                # The replica has left the system.
+                self.unregister_peer(pid)
+                return
+            try:
+                if len(batch) == 1:
+                    method, args = batch[0][:2]
+                    results = [getattr(stub, method)(*args)]
+                else:
+                    replies = stub.replicate_batch(
+                        [[method, list(args)] for method, args, _, _ in batch])
+                    results = [self._result(reply) for reply in replies]
+            except COMMUNICATION_ERRORS as e:
+                if not self._failed(pid, queue, e):
+                    return
+                continue
+            except Exception as e:
+                # A single update has failed, or the replica could not
+                # take the batch at all.
+                print("Replica {} failed to apply {} updates: {}".format(
+                    pid, len(batch), e))
+                results = [e] * len(batch)
+            with self.cond:
+                if queue.failing:
+                    queue.failing = False
+                    print("Replica {} has been repaired.".format(pid))
+                del queue.updates[:len(batch)]
+                for update, result in zip(batch, results):
+                    if update[2] is None:
+                        continue
+                    if isinstance(result, Exception):
+                        update[2].set_exception(result)
+                    else:
+                        update[2].set_result(result)
+                self.cond.notify_all()
+
+    def _result(self, reply):
+        """Return the result of an update of a batch, see _send_loop()."""
+        if "error" in reply:
+            error = reply["error"]
+            return type(error["name"], (Exception,), {})(*error["args"])
+        return reply["result"]
+
+    def _failed(self, pid, queue, error):
+        """Handle a replica that cannot be reached.
+
+        Returns whether its queue is to be retried.
+
+        """
+        if self.failed == REPAIR:
+            with self.cond:
+                if not queue.failing:
+                    print("Replica {} does not respond, queueing its "
+                          "updates.".format(pid))
+                queue.failing = True
+                queue.retry_at = time.monotonic() + self.repair_interval
+                self._fail(queue.updates, error)
+                self.cond.notify_all()
+            return True
+        self.unregister_peer(pid, error)
+        self.on_drop(pid)
+        return False
+
+    # Public methods
+
+    def destroy(self):
+        """Send the queued updates and stop the senders."""
+        self.flush()
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def unregister_peer(self, pid, error=None):
+        """Forget the queue of a replica that has left."""
+        with self.cond:
+            queue = self.queues.pop(pid, None)
+            if queue is not None:
+                self._fail(queue.updates, error or ConnectionError(
+                    "Replica {} has left the system.".format(pid)))
+                self.cond.notify_all()
+
+    def replicate(self, method, *args, pids=None, ack=None):
+        """Call method(*args) on all the replicas, or on the ones in pids.
+
+        Returns once the ack policy, or ack if given, is satisfied, see
+        wait(). Errors raised by the remote method itself on an
+        acknowledging replica are re-raised.
+
+        """
+        return self.wait(self.submit(method, *args, pids=pids, ack=ack), ack)
+
+    def submit(self, method, *args, pids=None, ack=None):
+        """Queue method(*args) for the replicas, without waiting.
+
+        Updates submitted one after the other are applied in this order
+        by every replica. Returns the futures of the replicas that may
+        acknowledge the update, for wait().
+
+        """
+        if ack is None:
+            ack = self.ack
+        if pids is None:
+            pids = list(self.peer_list.get_peers().keys())
+        futures = []
+        with self.cond:
+            due = time.monotonic()
+            if ack == LOCAL:
+                due += self.batch_delay
+            for pid in pids:
+                queue = self._queue(pid)
+                future = None
+                if not queue.failing:
+                    future = concurrent.futures.Future()
+                    futures.append(future)
+                queue.updates.append([method, args, future, due])
+            self.cond.notify_all()
+        return futures
+
+    def wait(self, futures, ack=None):
+        """Wait until enough of the futures of an update are done.
+
+        How many are enough is set by the ack policy, or by ack if
+        given. Returns the number of replicas that have applied the
+        update, which is lower than needed if some have failed or have
+        answered NotApplied.
+
+        """
+        if ack is None:
+            ack = self.ack
+        needed = self._needed(len(futures), ack)
+        acked = 0
+        if needed == 0:
+            return acked
+        error = None
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is None:
+                acked += 1
+                if acked >= needed:
+                    break
+            elif type(future.exception()).__name__ == NotApplied.__name__:
+                continue
+            elif not isinstance(future.exception(), COMMUNICATION_ERRORS):
+                error = error or future.exception()
+        if error is not None:
+            raise error
+        return acked
+
+    def flush(self):
+        """Send the queued updates now and wait until they are sent.
+
+        The queues of the replicas that do not respond are left as
+        they are.
+
+        """
+        with self.cond:
+            for queue in self.queues.values():
+                for update in queue.updates:
+                    update[3] = 0
+            self.cond.notify_all()
+            while any(queue.updates and not queue.failing
+                      for queue in self.queues.values()):
+                self.cond.wait()
+
+    def display_status(self):
+        """Print the replicas with queued updates."""
+        with self.cond:
+            for pid, queue in sorted(self.queues.items()):
+                if not queue.updates:
+                    continue
+                print("Replica {0} :: {1} queued updates{2}".format(
+                    pid, len(queue.updates),
+                    " (not responding)" if queue.failing else ""))
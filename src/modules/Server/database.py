@@ -9,46 +9,387 @@
 
 """Implementation of a simple database class."""
 
+import os
+import mmap
+import array
+import bisect
 import random
+import itertools
+import threading
+import zlib
 
+from .Lock.readWriteLock import StripedReadWriteLock, WRITER_PREFERRING
+from .searchIndex import SearchIndex
+from .hashTree import HashTree
 
-class Database(object):
+ROUND_ROBIN = "round-robin"
+HASH = "hash"
+
+
+def read_fortunes(db_file):
+    """Iterate over the fortunes stored in a fortune file.
+
+    The file is streamed, so arbitrarily large files can be imported
+    without loading them into memory first. Every fortune is returned
+    without its separator and trailing newlines, as the database stores
+    it.
+
+    """
+    with open(db_file, "r") as data:
+        lines = []
+        for line in data:
+            if line == "%\n":
+                yield "".join(lines).rstrip("\n")
+                lines = []
+            else:
+                lines.append(line)
+        if "".join(lines).strip():
+            yield "".join(lines).rstrip("\n")
+
+
+def shard_files(db_file, shards):
+    """Return the file names of the shards of a database.
+
+    The first shard is stored in db_file itself, so a database with a
+    single shard is the plain fortune file. The other shards are stored
+    next to it, e.g., dbs/fortune.1.db, dbs/fortune.2.db, ...
+
+    """
+    root, ext = os.path.splitext(db_file)
+    return [db_file] + ["{}.{}{}".format(root, i, ext)
+                        for i in range(1, shards)]
+
+
+class MappedRecords(object):
+
+    """Read-only view of the records of a memory mapped fortune file.
+
+    The file is mapped with read-only access, so several processes
+    opening the same file share a single page-cached copy of it. Record
+    boundaries are found the first time the records are used and each
+    record is only decoded when it is accessed. Records are returned in
+    the same form as read_fortunes() returns them.
+
+    """
 
-    """Class containing a database implementation."""
-    database = []
     def __init__(self, db_file):
+        self.map = None
+        self.starts = None
+        self.ends = None
+        self.lock = threading.Lock()
+        if os.path.exists(db_file) and os.path.getsize(db_file) > 0:
+            with open(db_file, "rb") as data:
+                self.map = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _scan(self):
+        """Find the boundaries of all the records in the file."""
+        with self.lock:
+            if self.starts is not None:
+                return
+            starts = array.array("Q")
+            ends = array.array("Q")
+            if self.map is not None:
+                pos = 0
+                while True:
+                    if self.map[pos:pos + 2] == b"%\n":
+                        # An empty record.
+                        starts.append(pos)
+                        ends.append(pos)
+                        pos += 2
+                        continue
+                    sep = self.map.find(b"\n%\n", pos)
+                    if sep == -1:
+                        break
+                    starts.append(pos)
+                    ends.append(sep)
+                    pos = sep + 3
+                if self.map[pos:].strip():
+                    # The last record has no separator.
+                    starts.append(pos)
+                    ends.append(len(self.map))
+            self.ends = ends
+            self.starts = starts
+
+    def __len__(self):
+        if self.starts is None:
+            self._scan()
+        return len(self.starts)
+
+    def __getitem__(self, n):
+        if self.starts is None:
+            self._scan()
+        if isinstance(n, slice):
+            return [self[i] for i in range(*n.indices(len(self)))]
+        return self.map[self.starts[n]:self.ends[n]].decode(
+            "utf-8").rstrip("\n")
+
+
+class Shard(object):
+
+    """One file of the database, its records and the lock guarding them.
+
+    When index is set, the shard also keeps a search index over its
+    records, saved next to the data file with the '.idx' suffix. When
+    read_only is set, the file is memory mapped instead of parsed.
+
+    The lock of the shard follows policy, see ReadWriteLock.
+
+    Records are kept as read_fortunes() returns them, whether read from
+    the file, memory mapped or just appended.
+
+    """
+
+    def __init__(self, db_file, index=False, read_only=False,
+                 policy=WRITER_PREFERRING):
+        self.db_file = db_file
+        self.records = []
+        self.lock = StripedReadWriteLock(policy=policy)
+        self.index = None
+        if read_only:
+            self.records = MappedRecords(db_file)
+        elif os.path.exists(db_file):
+            self.records = list(read_fortunes(db_file))
+        if index:
+            self.index = SearchIndex(db_file + ".idx", read_only)
+            self.index.load(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, fortunes):
+        """Append fortunes to the shard. The caller holds the write lock."""
+        first = len(self.records)
+        with open(self.db_file, "a") as data:
+            for fortune in fortunes:
+                fortune = fortune.rstrip("\n")
+                self.records.append(fortune)
+                data.write(fortune + "\n%\n")
+        if self.index is not None:
+            self.index.add(self.records[first:])
+        return len(self.records) - first
+
+
+class Database(object):
+
+    """Class containing a database implementation.
+
+    The fortunes can be split over several shards, each with its own
+    file, lock and optional search index, so that writes to different
+    shards do not wait for each other. New fortunes are routed to a shard either round-robin
+    or by a hash of their text. Reads pick a shard with a probability
+    proportional to its size, so every fortune is equally likely to be
+    returned no matter where it is stored.
+
+    A read-only database memory maps its files instead of loading them,
+    see MappedRecords, and refuses all writes.
+
+    The locks of the shards follow policy, see ReadWriteLock.
+
+    A hash tree over all the records, see HashTree, is built the first
+    time it is asked for and then kept up to date by the writes. It
+    also maps its buckets to the records in them, for bucket_records().
+
+    """
+
+    def __init__(self, db_file, shards=1, route=ROUND_ROBIN, index=False,
+                 read_only=False, policy=WRITER_PREFERRING):
+        if shards < 1:
+            raise ValueError("A database needs at least one shard.")
+        if route not in (ROUND_ROBIN, HASH):
+            raise ValueError("Unknown shard routing: '{}'".format(route))
         self.db_file = db_file
+        self.route = route
+        self.read_only = read_only
         self.rand = random.Random()
         self.rand.seed()
-        #
-        # Your code here.
-        #
-        data = open(db_file,"r") 
-        res = ""
-        for i in data:
-            if i == "%\n": 
-                self.database.append(res)
-                res = ""
-                i = ""
-            res = res + "\n" + i
-        data.close()
-        pass
+        self.shards = [Shard(f, index, read_only, policy)
+                       for f in shard_files(db_file, shards)]
+        self.next_shard = itertools.count()
+        self.tree = None
+        self.tree_lock = threading.Lock()
+
+    # Private methods
+
+    def _check_writable(self):
+        if self.read_only:
+            raise Exception("The database is opened read-only.")
+
+    def _track(self, shard, count):
+        """Add the last count records of shard to the hash tree.
+
+        The caller holds the write lock of the shard.
+
+        """
+        if self.tree is not None and count > 0:
+            self._hash_records(self.tree, shard, len(shard.records) - count)
+
+    def _hash_records(self, tree, shard, first, last=None):
+        """Add the records first to last of shard to tree."""
+        if last is None:
+            last = len(shard.records)
+        s = self.shards.index(shard)
+        tree.add((shard.records[n] for n in range(first, last)),
+                 ((s, n) for n in range(first, last)))
+
+    def _route(self, fortune):
+        """Choose the shard a new fortune is written to."""
+        return self.shards[self.shard_of(fortune)]
+
+    # Public methods
+
+    def shard_of(self, fortune):
+        """Return the number of the shard a new fortune is written to.
+
+        With hash routing the answer only depends on the fortune, so it
+        is the same on every replica of the database.
+
+        """
+        if len(self.shards) == 1:
+            return 0
+        if self.route == HASH:
+            key = zlib.crc32(fortune.encode("utf-8"))
+        else:
+            key = next(self.next_shard)
+        return key % len(self.shards)
+
+    def size(self):
+        """Return the number of fortunes in the database."""
+        return sum(len(shard) for shard in self.shards)
 
     def read(self):
         """Read a random location in the database."""
-        #
-        # Your code here.
-        #
-        return self.rand.choice(self.database)
-        pass
+        weights = [len(shard) for shard in self.shards]
+        shard = self.rand.choices(self.shards, weights=weights)[0]
+        shard.lock.read_acquire()
+        try:
+            return self.rand.choice(shard.records)
+        finally:
+            shard.lock.read_release()
+
+    def read_many(self, n, unique=False):
+        """Read n random locations in the database.
+
+        All the locations are drawn in a single sampling step over the
+        whole database. When unique is set, they are drawn without
+        replacement, so n may not exceed the number of fortunes in the
+        database.
+
+        """
+        sizes = [len(shard) for shard in self.shards]
+        offsets = list(itertools.accumulate(sizes))
+        population = range(offsets[-1])
+        if unique:
+            indices = self.rand.sample(population, n)
+        else:
+            indices = self.rand.choices(population, k=n)
+        # Group the indices per shard so that each lock is taken once.
+        wanted = {}
+        for pos, index in enumerate(indices):
+            s = bisect.bisect_right(offsets, index)
+            base = offsets[s - 1] if s > 0 else 0
+            wanted.setdefault(s, []).append((pos, index - base))
+        result = [None] * len(indices)
+        for s, locations in wanted.items():
+            shard = self.shards[s]
+            shard.lock.read_acquire()
+            try:
+                for pos, index in locations:
+                    result[pos] = shard.records[index]
+            finally:
+                shard.lock.read_release()
+        return result
 
     def write(self, fortune):
         """Write a new fortune to the database."""
-        #
-        # Your code here.
-        #
-        fortune = fortune + '\n' + "%\n"
-        self.database.append(fortune)
-        data = open(self.db_file,"a")
-        data.write(fortune)
-        pass
+        self._check_writable()
+        shard = self._route(fortune)
+        shard.lock.write_acquire()
+        try:
+            self._track(shard, shard.append([fortune]))
+        finally:
+            shard.lock.write_release()
+
+    def write_many(self, fortunes):
+        """Write several fortunes to the database in one pass.
+
+        fortunes can be any iterable, including a generator. With a
+        single shard the stream is appended without being materialized.
+        The number of fortunes written is returned.
+
+        """
+        self._check_writable()
+        if len(self.shards) == 1:
+            batches = {self.shards[0]: fortunes}
+        else:
+            batches = {}
+            for fortune in fortunes:
+                batches.setdefault(self._route(fortune), []).append(fortune)
+        count = 0
+        for shard, batch in batches.items():
+            shard.lock.write_acquire()
+            try:
+                added = shard.append(batch)
+                self._track(shard, added)
+                count += added
+            finally:
+                shard.lock.write_release()
+        return count
+
+    def search(self, query, limit=10):
+        """Return at most limit fortunes containing all words of query."""
+        if self.shards[0].index is None:
+            raise Exception("The database has no search index.")
+        result = []
+        for shard in self.shards:
+            if len(result) >= limit:
+                break
+            shard.lock.read_acquire()
+            try:
+                for n in shard.index.search(query)[:limit - len(result)]:
+                    result.append(shard.records[n])
+            finally:
+                shard.lock.read_release()
+        return result
+
+    def hash_tree(self):
+        """Return the hash tree of the database."""
+        with self.tree_lock:
+            if self.tree is None:
+                # The records are only ever appended, so the ones there
+                # already are hashed without blocking the writers. Only
+                # the ones written meanwhile are added under the locks,
+                # after which the writes keep the tree up to date.
+                tree = HashTree()
+                hashed = []
+                for shard in self.shards:
+                    hashed.append(len(shard.records))
+                    self._hash_records(tree, shard, 0, hashed[-1])
+                for shard in self.shards:
+                    shard.lock.read_acquire()
+                try:
+                    for shard, first in zip(self.shards, hashed):
+                        self._hash_records(tree, shard, first)
+                    self.tree = tree
+                finally:
+                    for shard in reversed(self.shards):
+                        shard.lock.read_release()
+            return self.tree
+
+    def bucket_records(self, buckets):
+        """Return the fortunes in the given buckets of the hash tree."""
+        wanted = {}
+        for s, n in self.hash_tree().locations(buckets):
+            wanted.setdefault(s, []).append(n)
+        result = []
+        for s, locations in sorted(wanted.items()):
+            shard = self.shards[s]
+            shard.lock.read_acquire()
+            try:
+                result.extend(shard.records[n] for n in locations)
+            finally:
+                shard.lock.read_release()
+        return result
+
+    def import_file(self, db_file):
+        """Append all the fortunes of another fortune file."""
+        return self.write_many(read_fortunes(db_file))
@@ -0,0 +1,124 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Hash tree over the records of a database, for comparing replicas.
+
+Replicas append the same fortunes in different orders, so the tree does
+not depend on the order of the records: every record is put in one of
+2**depth buckets by a hash of its text, and every node of the tree holds
+the number of records below it and the sum of their hashes. Two replicas
+with the same root hold the same records; otherwise, the differing
+buckets are found by comparing the children of the differing nodes only.
+
+Adding a record updates the nodes on the path from its bucket to the
+root, so the tree is kept up to date as the database grows. The tree
+also remembers where the records of every bucket are stored, so that
+they can be fetched without hashing the whole database again.
+
+The nodes are numbered as in a heap: the root is 1 and the children of
+node i are 2 * i and 2 * i + 1, so the leaves are 2**depth to
+2**(depth + 1) - 1.
+
+"""
+
+import array
+import hashlib
+import itertools
+import threading
+
+# The hashes, and their sums, are taken modulo 2**HASH_BITS.
+HASH_BITS = 128
+
+
+class HashTree(object):
+
+    """Order independent hash tree over a set of records.
+
+    Public methods:
+        --  __init__(depth=12)
+        --  bucket_of(record)
+        --  add(records, locations=None)
+        --  locations(buckets)
+        --  nodes(indexes)
+        --  is_leaf(index)
+        --  children(index)
+        --  bucket(index)
+
+    """
+
+    def __init__(self, depth=12):
+        self.depth = depth
+        self.leaves = 1 << depth
+        self.lock = threading.Lock()
+        self.counts = array.array("q", [0]) * (2 * self.leaves)
+        self.sums = [0] * (2 * self.leaves)
+        # The locations of the records of every bucket, by bucket.
+        self.members = {}
+
+    # Private methods
+
+    def _hash(self, record):
+        digest = hashlib.blake2b(record.encode("utf-8"),
+                                 digest_size=HASH_BITS // 8).digest()
+        return int.from_bytes(digest, "big")
+
+    # Public methods
+
+    def bucket_of(self, record):
+        """Return the bucket of a record."""
+        return self._hash(record) >> (HASH_BITS - self.depth)
+
+    def add(self, records, locations=None):
+        """Add records to the tree.
+
+        locations, if given, tells where every record is stored, in the
+        same order as records; see locations().
+
+        """
+        mask = (1 << HASH_BITS) - 1
+        touched = set()
+        if locations is None:
+            locations = itertools.repeat(None)
+        with self.lock:
+            for record, location in zip(records, locations):
+                h = self._hash(record)
+                bucket = h >> (HASH_BITS - self.depth)
+                leaf = self.leaves + bucket
+                if location is not None:
+                    self.members.setdefault(bucket, []).append(location)
+                self.counts[leaf] += 1
+                self.sums[leaf] = (self.sums[leaf] + h) & mask
+                touched.add(leaf // 2)
+            # Update the inner nodes level by level, so that a large
+            # batch (e.g., a whole file) costs one pass over the tree.
+            while touched:
+                parents = set()
+                for i in touched:
+                    self.counts[i] = self.counts[2 * i] + self.counts[2 * i + 1]
+                    self.sums[i] = (self.sums[2 * i] +
+                                    self.sums[2 * i + 1]) & mask
+                    if i > 1:
+                        parents.add(i // 2)
+                touched = parents
+
+    def locations(self, buckets):
+        """Return the locations of the records in the given buckets."""
+        with self.lock:
+            return [location for bucket in buckets
+                    for location in self.members.get(bucket, [])]
+
+    def nodes(self, indexes):
+        """Return the nodes with the given numbers, as [count, sum]."""
+        with self.lock:
+            return [[self.counts[i], self.sums[i]] for i in indexes]
+
+    def is_leaf(self, index):
+        return index >= self.leaves
+
+    def children(self, index):
+        return [2 * index, 2 * index + 1]
+
+    def bucket(self, index):
+        """Return the bucket of a leaf."""
+        return index - self.leaves
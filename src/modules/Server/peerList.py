@@ -10,17 +10,29 @@
 """Package for handling a list of objects of the same type as a given one."""
 
 import threading
+import concurrent.futures
 from Common import orb
 
+COMMUNICATION_ERRORS = orb.COMMUNICATION_ERRORS
+
+
+class UnknownPeer(Exception):
+
+    """Raised when unregistering a peer that is not in the list."""
+
+    pass
+
 
 class PeerList(object):
 
     """Class that builds a list of objects of the same type as this one."""
 
-    def __init__(self, owner):
+    def __init__(self, owner, max_parallel=8):
         self.owner = owner
         self.lock = threading.Condition()
         self.peers = {}
+        # Bounds the number of calls broadcast() runs in parallel.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_parallel)
 
     # Public methods
 
@@ -101,10 +113,20 @@ class PeerList(object):
                 del self.peers[pid]
                 print("Peer {} has left the system.".format(pid))
             else:
-                raise Exception("No peer with id: '{}'".format(pid))
+                raise UnknownPeer("No peer with id: '{}'".format(pid))
         finally:
             self.lock.release()
 
+    def drop(self, pid):
+        """Unregister, through the owner, a peer that does not respond."""
+
+        print("Peer {} does not respond, removing it.".format(pid))
+        try:
+            self.owner.unregister_peer(pid)
+        except UnknownPeer:
+            # Somebody else has already removed it.
+            pass
+
     def display_peers(self):
         """Display all the peers in the list."""
 
@@ -135,3 +157,41 @@ class PeerList(object):
             return self.peers
         finally:
             self.lock.release()
+
+    def broadcast(self, method, *args, pids=None):
+        """Call a method on several peers concurrently.
+
+        The call goes to the peers in pids, or to all peers if pids is
+        None, with at most max_parallel calls in flight. Returns a pair
+        (results, failed) of dictionaries: the results of the peers
+        that answered and the errors of the peers that could not be
+        reached. Errors raised by the remote method itself are re-raised
+        once all the calls have completed.
+
+        """
+
+        self.lock.acquire()
+        try:
+            if pids is None:
+                pids = list(self.peers.keys())
+            targets = [(pid, self.peers[pid]) for pid in pids
+                       if pid in self.peers]
+        finally:
+            self.lock.release()
+
+        futures = dict((pid, self.executor.submit(getattr(stub, method),
+                                                  *args))
+                       for pid, stub in targets)
+        results = {}
+        failed = {}
+        error = None
+        for pid, future in futures.items():
+            try:
+                results[pid] = future.result()
+            except COMMUNICATION_ERRORS as e:
+                failed[pid] = e
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return results, failed
@@ -0,0 +1,96 @@
+# -----------------------------------------------------------------------------
+# Distributed Systems (TDDD25)
+# -----------------------------------------------------------------------------
+
+"""Inverted index used for keyword searches in a fortune database.
+
+The index maps every word to the (sorted) list of the numbers of the
+records that contain it. It is kept on disk as a journal next to the
+data file: line i of the journal holds the words of record i. New
+records only append lines to the journal, so the index is maintained
+incrementally and never has to be rewritten. A read-only index uses the
+journal but never modifies it.
+
+"""
+
+import os
+import re
+import json
+
+WORD = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Return the set of (lower case) words of a text."""
+    return set(WORD.findall(text.lower()))
+
+
+class SearchIndex(object):
+
+    """Inverted index over the records of one database file."""
+
+    def __init__(self, index_file, read_only=False):
+        self.index_file = index_file
+        self.read_only = read_only
+        self.postings = {}
+        self.count = 0
+
+    # Private methods
+
+    def _insert(self, terms):
+        for term in terms:
+            self.postings.setdefault(term, []).append(self.count)
+        self.count += 1
+
+    # Public methods
+
+    def load(self, records):
+        """Load the index from its journal and catch up with records.
+
+        If the journal describes more records than there are, it does
+        not belong to this data file and the index is rebuilt.
+
+        """
+        self.postings = {}
+        self.count = 0
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r") as journal:
+                for line in journal:
+                    if self.count == len(records):
+                        self.count = len(records) + 1
+                        break
+                    self._insert(json.loads(line))
+            if self.count > len(records):
+                self.postings = {}
+                self.count = 0
+                if not self.read_only:
+                    os.remove(self.index_file)
+        self.add(records[self.count:])
+
+    def add(self, records):
+        """Index new records, appended after the ones already indexed."""
+        if not records:
+            return
+        if self.read_only:
+            for record in records:
+                self._insert(tokenize(record))
+            return
+        with open(self.index_file, "a") as journal:
+            for record in records:
+                terms = sorted(tokenize(record))
+                self._insert(terms)
+                journal.write(json.dumps(terms) + "\n")
+
+    def search(self, query):
+        """Return the numbers of the records containing all query words."""
+        terms = tokenize(query)
+        if not terms:
+            return []
+        lists = sorted((self.postings.get(t, []) for t in terms), key=len)
+        result = lists[0]
+        for other in lists[1:]:
+            if not result:
+                break
+            other = set(other)
+            result = [n for n in result if n in other]
+        return result